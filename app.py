@@ -1,7 +1,25 @@
-from flask import Flask, jsonify, render_template, request
+import hmac
+import json
+import os
+import queue
+from flask import Flask, Response, jsonify, render_template, request
+import data_manager
 from data_manager import get_user, update_user
+from events import hub
+import rules
+import quotas
+import traffic
+
+# Seconds between keep-alive comments on idle event streams.
+EVENT_STREAM_KEEPALIVE = 15
 
 app = Flask(__name__)
+# Oversized bodies are rejected from the Content-Length header, before parsing.
+app.config['MAX_CONTENT_LENGTH'] = quotas.MAX_REQUEST_BYTES
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({"error": f"Request body too large (max {quotas.MAX_REQUEST_BYTES} bytes)"}), 413
 
 @app.route('/')
 def hello_world():
@@ -16,6 +34,29 @@ def get_user_api(user_id):
     user_data = get_user(user_id)
     return jsonify(user_data)
 
+@app.route('/api/user/<user_id>/events')
+def user_events_api(user_id):
+    """Server-Sent Events stream of incremental changes to a user's data."""
+    # Subscribe before the response starts so no update is missed in between.
+    subscription = hub.subscribe(user_id)
+    data_manager.watcher.ensure_started() # Also streams changes made by the bot process
+
+    def stream():
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                event = subscription.get(timeout=EVENT_STREAM_KEEPALIVE)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield f"data: {json.dumps(event)}\n\n"
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Disable proxy buffering (nginx)
+    response.call_on_close(lambda: hub.unsubscribe(user_id, subscription))
+    return response
+
 @app.route('/api/user/<user_id>/tasks', methods=['POST'])
 def add_task_api(user_id):
     data = request.get_json()
@@ -24,13 +65,21 @@ def add_task_api(user_id):
 
     task_name = data['name']
     task_description = data.get('description', '') # Optional description
+    error = quotas.check_fields(name=task_name, description=task_description)
+    if error:
+        return jsonify({"error": error}), 400
 
     user_data = get_user(user_id)
     if not user_data:
         return jsonify({"error": "User not found"}), 404
 
+    task = {"description": task_description, "completed": False}
+    error = quotas.check_item(user_id, user_data, 'tasks', task_name, task)
+    if error:
+        return jsonify({"error": error}), 403
+
     # For now, task_name is the ID. If it exists, it's overwritten.
-    user_data['tasks'][task_name] = {"description": task_description, "completed": False}
+    user_data['tasks'][task_name] = task
 
     update_user(user_id, user_data)
     return jsonify({"message": "Task added successfully", "task": {task_name: user_data['tasks'][task_name]}}), 201
@@ -40,6 +89,11 @@ def edit_task_api(user_id, task_id):
     data = request.get_json()
     if not data:
         return jsonify({"error": "Request body is required"}), 400
+    error = quotas.check_fields(description=data.get('description'))
+    if error:
+        return jsonify({"error": error}), 400
+    if 'completed' in data and not isinstance(data['completed'], bool):
+        return jsonify({"error": "Field 'completed' must be true or false"}), 400
 
     user_data = get_user(user_id)
     if not user_data:
@@ -50,26 +104,26 @@ def edit_task_api(user_id, task_id):
 
     task = user_data['tasks'][task_id]
     previous_completed_status = task.get('completed', False)
+    edited_task = {
+        **task,
+        'description': data.get('description', task.get('description', '')),
+        'completed': data.get('completed', task.get('completed', False)),
+    }
+    error = quotas.check_item(user_id, user_data, 'tasks', task_id, edited_task)
+    if error:
+        return jsonify({"error": error}), 403
 
     # Update task fields
-    task['description'] = data.get('description', task.get('description', ''))
-    task['completed'] = data.get('completed', task.get('completed', False))
+    task['description'] = edited_task['description']
+    task['completed'] = edited_task['completed']
     # Potentially other fields like 'name' if we allow renaming,
     # but that's complex if name is ID.
 
     # Handle stat changes based on completion status change
     if task['completed'] and not previous_completed_status: # Task marked complete
-        user_data['experience'] = user_data.get('experience', 0) + 10
-        user_data['gold'] = user_data.get('gold', 0) + 5
+        rules.apply_deltas(user_data, rules.TASK_COMPLETED)
     elif not task['completed'] and previous_completed_status: # Task marked incomplete from complete (e.g. undo)
-        # Optional: Revert stat changes, or handle as a penalty, or do nothing
-        # For now, let's assume undoing completion reverts the positive reward
-        user_data['experience'] = user_data.get('experience', 0) - 10
-        user_data['gold'] = user_data.get('gold', 0) - 5
-        # Ensure stats don't go negative if that's a rule
-        user_data['experience'] = max(0, user_data['experience'])
-        user_data['gold'] = max(0, user_data['gold'])
-
+        rules.apply_deltas(user_data, rules.TASK_UNCOMPLETED)
 
     user_data['tasks'][task_id] = task # Update the task in user_data
     update_user(user_id, user_data)
@@ -104,8 +158,7 @@ def fail_task_api(user_id, task_id):
     # Optional: add a 'failed_count' or 'last_failed_date' if needed
 
     # Deduct health for failing a task
-    user_data['health'] = user_data.get('health', 100) - 10 # Standard task failure penalty
-    user_data['health'] = max(0, user_data['health']) # Ensure health doesn't go below 0
+    rules.apply_deltas(user_data, rules.TASK_FAILED)
 
     user_data['tasks'][task_id] = task # Save changes to the task
     update_user(user_id, user_data)
@@ -132,6 +185,9 @@ def add_habit_api(user_id):
     # Optional fields for a habit
     frequency = data.get('frequency', 'daily')
     description = data.get('description', '')
+    error = quotas.check_fields(name=habit_name, description=description, frequency=frequency)
+    if error:
+        return jsonify({"error": error}), 400
 
     user_data = get_user(user_id)
     if not user_data:
@@ -140,13 +196,18 @@ def add_habit_api(user_id):
     if 'habits' not in user_data: # Should be initialized by get_user, but as a safeguard
         user_data['habits'] = {}
 
-    # For now, habit_name is the ID. If it exists, it's overwritten.
-    user_data['habits'][habit_name] = {
+    habit = {
         "description": description,
         "frequency": frequency,
         "streak": 0,
         "last_completed_date": None # Could be ISO date string
     }
+    error = quotas.check_item(user_id, user_data, 'habits', habit_name, habit)
+    if error:
+        return jsonify({"error": error}), 403
+
+    # For now, habit_name is the ID. If it exists, it's overwritten.
+    user_data['habits'][habit_name] = habit
 
     update_user(user_id, user_data)
     return jsonify({"message": "Habit added successfully", "habit": {habit_name: user_data['habits'][habit_name]}}), 201
@@ -156,12 +217,22 @@ def edit_habit_api(user_id, habit_id):
     data = request.get_json()
     if not data:
         return jsonify({"error": "Request body is required"}), 400
+    error = quotas.check_fields(description=data.get('description'), frequency=data.get('frequency'))
+    if error:
+        return jsonify({"error": error}), 400
 
     user_data = get_user(user_id)
     if not user_data or 'habits' not in user_data or habit_id not in user_data['habits']:
         return jsonify({"error": "Habit not found or user data incomplete"}), 404
 
     habit = user_data['habits'][habit_id]
+    error = quotas.check_item(user_id, user_data, 'habits', habit_id, {
+        **habit,
+        'description': data.get('description', habit.get('description', '')),
+        'frequency': data.get('frequency', habit.get('frequency', 'daily')),
+    })
+    if error:
+        return jsonify({"error": error}), 403
 
     # Update allowed fields
     habit['description'] = data.get('description', habit.get('description', ''))
@@ -198,8 +269,7 @@ def complete_habit_api(user_id, habit_id):
     habit['last_completed_date'] = datetime.now(timezone.utc).isoformat()
 
     # Update user stats (gamification)
-    user_data['experience'] = user_data.get('experience', 0) + 5 # Less XP than tasks, more frequent
-    user_data['gold'] = user_data.get('gold', 0) + 2 # Less gold
+    rules.apply_deltas(user_data, rules.HABIT_COMPLETED)
 
     user_data['habits'][habit_id] = habit
     update_user(user_id, user_data)
@@ -217,10 +287,7 @@ def fail_habit_api(user_id, habit_id):
     habit['streak'] = 0 # Reset streak on failure
 
     # Update user stats (gamification)
-    user_data['health'] = user_data.get('health', 100) - 5 # Minor health loss for failing a habit
-    # Ensure health doesn't go below 0 if that's a rule, or handle "death" state
-    user_data['health'] = max(0, user_data['health'])
-
+    rules.apply_deltas(user_data, rules.HABIT_FAILED)
 
     user_data['habits'][habit_id] = habit
     update_user(user_id, user_data)
@@ -235,5 +302,42 @@ def fail_habit_api(user_id, habit_id):
 
     return jsonify(response_data), 200
 
+# --- Admin Endpoints ---
+
+def is_admin_request():
+    """Admin endpoints require ADMIN_TOKEN to be set and sent in the X-Admin-Token header."""
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    sent_token = request.headers.get('X-Admin-Token', '')
+    # Constant-time comparison, so response timing does not reveal the token.
+    return bool(admin_token) and hmac.compare_digest(sent_token.encode('utf-8'), admin_token.encode('utf-8'))
+
+@app.route('/api/admin/largest_users')
+def largest_users_api():
+    """Reports the users with the most stored data."""
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+
+    limit = request.args.get('limit', 10, type=int)
+    users = [{"user_id": user_id, "bytes": size} for user_id, size in quotas.usage.largest(limit)]
+    return jsonify({"users": users, "max_user_bytes": quotas.MAX_USER_BYTES}), 200
+
+@app.route('/api/admin/leaderboard')
+def leaderboard_api():
+    """Top users by a stat, scanned across all storage partitions in parallel."""
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+
+    stat = request.args.get('stat', 'experience')
+    if stat not in rules.STAT_DEFAULTS:
+        return jsonify({"error": f"Unknown stat '{stat}'"}), 400
+    limit = request.args.get('limit', 10, type=int)
+    users = [{"user_id": user_id, stat: value} for user_id, value in data_manager.leaderboard(stat, limit)]
+    return jsonify({"users": users}), 200
+
+# Record sanitized API traffic for replay when TELEHABIT_CAPTURE_FILE is set.
+_capture = traffic.capture_from_env()
+if _capture is not None:
+    app.wsgi_app = traffic.CaptureMiddleware(app.wsgi_app, *_capture)
+
 if __name__ == '__main__':
     app.run(debug=True)
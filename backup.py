@@ -0,0 +1,308 @@
+"""Incremental backups and point-in-time restore for user data.
+
+Each user's record is stored once in a content-addressed chunk store
+(``chunks/<hash>.json``). A backup writes only the chunks of users that
+changed since the previous backup, plus a small manifest listing those
+changes. Users whose version is unchanged since the previous backup are not
+even re-encoded or hashed, so its cost follows churn rather than the number
+of users.
+
+When users are partitioned across storage nodes (data_manager.STORE), every
+node is backed up as its own series of manifests (``nodes/<node id>/``),
+sharing the chunk store, and a restore puts every user back on the node that
+owns it now.
+
+Usage:
+    python backup.py create
+    python backup.py list
+    python backup.py restore [--at 2026-10-18T12:00:00+00:00] [--output FILE]
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+from datetime import datetime, timezone
+
+import data_manager
+
+BACKUP_DIR = 'backups' # Module-level variable, like data_manager.DATA_FILE
+
+
+def _chunks_dir():
+    return os.path.join(BACKUP_DIR, 'chunks')
+
+
+def _series_dir(node_id=None):
+    """Directory of the manifests and HEAD of the data file, or of one storage node."""
+    if node_id is None:
+        return BACKUP_DIR
+    return os.path.join(BACKUP_DIR, 'nodes', node_id)
+
+
+def _manifests_dir(node_id=None):
+    return os.path.join(_series_dir(node_id), 'manifests')
+
+
+def _head_file(node_id=None):
+    return os.path.join(_series_dir(node_id), 'HEAD.json')
+
+
+def _write_json_atomic(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def _read_json(path, default=None):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def _encode_user(user):
+    """Serializes a user record canonically so equal records hash equally."""
+    return json.dumps(user, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def store_chunk(payload):
+    """Stores a serialized user record and returns its content hash."""
+    digest = hashlib.sha256(payload).hexdigest()
+    path = os.path.join(_chunks_dir(), digest[:2], digest + '.json')
+    if not os.path.exists(path): # Identical records are only stored once
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_file, path)
+    return digest
+
+
+def load_chunk(digest):
+    with open(os.path.join(_chunks_dir(), digest[:2], digest + '.json'), 'rb') as f:
+        return json.loads(f.read())
+
+
+def create_backup(now=None, node=None):
+    """Takes an incremental backup of the data file, or of one storage node.
+
+    Returns the new manifest, or None if nothing changed since the last backup.
+    """
+    now = now or datetime.now(timezone.utc)
+    # Data files are replaced atomically, so this read is a consistent
+    # snapshot and never blocks writers.
+    users = data_manager.load_user_data() if node is None else node.load_all()
+    node_id = None if node is None else node.name
+
+    # HEAD maps each user to [version, digest] as of the last backup (older
+    # HEADs hold just the digest).
+    head = _read_json(_head_file(node_id), default={"backup_id": None, "users": {}})
+    previous = head["users"]
+    current = {}
+    changed = {}
+    for user_id, user in users.items():
+        version = user.get('version')
+        entry = previous.get(user_id)
+        if version is not None and isinstance(entry, list) and entry[0] == version:
+            # Every update bumps the version, so an unchanged version means an
+            # unchanged record: skip encoding and hashing it.
+            current[user_id] = entry
+            continue
+        payload = _encode_user(user)
+        digest = hashlib.sha256(payload).hexdigest()
+        current[user_id] = [version, digest]
+        previous_digest = entry[1] if isinstance(entry, list) else entry
+        if previous_digest != digest:
+            changed[user_id] = store_chunk(payload)
+    removed = [user_id for user_id in previous if user_id not in current]
+
+    if head["backup_id"] is not None and not changed and not removed:
+        return None
+
+    manifest = {
+        "backup_id": now.strftime('%Y%m%dT%H%M%S%fZ'),
+        "created_at": now.isoformat(),
+        "parent": head["backup_id"],
+        "changed": changed,
+        "removed": removed,
+    }
+    _write_json_atomic(os.path.join(_manifests_dir(node_id), manifest["backup_id"] + '.json'), manifest)
+    # HEAD is written last: a crash before this point only leaves unused chunks.
+    _write_json_atomic(_head_file(node_id), {"backup_id": manifest["backup_id"], "users": current})
+    return manifest
+
+
+def create_backups(now=None):
+    """Backs up the data file, or every storage node when users are partitioned.
+
+    Returns [(node_id, manifest or None)]; node_id is None for the data file.
+    """
+    if data_manager.STORE is None:
+        return [(None, create_backup(now))]
+    return [(node.name, create_backup(now, node)) for node in data_manager.STORE.nodes]
+
+
+def backed_up_node_ids():
+    """Returns the ids of the storage nodes that have backups."""
+    try:
+        return sorted(os.listdir(os.path.join(BACKUP_DIR, 'nodes')))
+    except FileNotFoundError:
+        return []
+
+
+def list_backups(node_id=None):
+    """Returns the backup manifests of the data file (or of one node), oldest first."""
+    try:
+        names = sorted(os.listdir(_manifests_dir(node_id)))
+    except FileNotFoundError:
+        return []
+    return [_read_json(os.path.join(_manifests_dir(node_id), name))
+            for name in names if name.endswith('.json')]
+
+
+def state_at(point_in_time=None, node_id=None):
+    """Rebuilds the full user data as of the latest backup at or before a time.
+
+    point_in_time is an aware datetime; None means the latest backup.
+    node_id selects a storage node's backups instead of the data file's.
+    Raises LookupError if no backup is old enough.
+    """
+    manifests = list_backups(node_id)
+    if point_in_time is not None:
+        manifests = [m for m in manifests
+                     if datetime.fromisoformat(m["created_at"]) <= point_in_time]
+    if not manifests:
+        raise LookupError("No backup found at or before the requested time")
+
+    by_id = {m["backup_id"]: m for m in manifests}
+    chain = []
+    backup_id = manifests[-1]["backup_id"]
+    while backup_id is not None:
+        manifest = by_id[backup_id]
+        chain.append(manifest)
+        backup_id = manifest["parent"]
+
+    hashes = {}
+    for manifest in reversed(chain):
+        hashes.update(manifest["changed"])
+        for user_id in manifest["removed"]:
+            hashes.pop(user_id, None)
+    return {user_id: load_chunk(digest) for user_id, digest in hashes.items()}
+
+
+def advance_versions(users, current):
+    """Gives every restored user a version above both its backed-up and current one.
+
+    Versions must never repeat: the bot's status panel treats an unchanged
+    version as unchanged data, both in its render cache and when deciding
+    whether a tapped panel is stale, and a long-running process (or another
+    one) may have seen the versions a restore would otherwise bring back.
+    """
+    for user_id, user in users.items():
+        current_version = (current.get(user_id) or {}).get('version', 0)
+        user['version'] = max(user.get('version', 0), current_version) + 1
+    return users
+
+
+def partitioned_state_at(point_in_time=None):
+    """Rebuilds all users from every storage node's backups, like state_at.
+
+    Users may have moved between nodes since (a reshard), so the nodes'
+    states are merged; a user found on two nodes keeps its newest version.
+    """
+    users = {}
+    found = False
+    for node_id in backed_up_node_ids():
+        try:
+            node_users = state_at(point_in_time, node_id)
+        except LookupError:
+            continue # Node added after point_in_time
+        found = True
+        for user_id, user in node_users.items():
+            if user_id not in users or user.get('version', 0) > users[user_id].get('version', 0):
+                users[user_id] = user
+    if not found:
+        raise LookupError("No backup found at or before the requested time")
+    return users
+
+
+def restore(point_in_time=None, output_file=None):
+    """Restores user data from a backup into output_file (default: the live data).
+
+    With storage nodes, every user is written to the node that owns it now.
+    """
+    store = data_manager.STORE
+    if store is None:
+        users = advance_versions(state_at(point_in_time), data_manager.load_user_data())
+    else:
+        users = advance_versions(partitioned_state_at(point_in_time), store.all_users())
+    if output_file is None and store is not None:
+        store.replace_all(users)
+    elif output_file is None:
+        data_manager.save_user_data(users)
+    else:
+        _write_json_atomic(os.path.abspath(output_file), users)
+    return users
+
+
+def _parse_time(value):
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc) # Naive times are UTC
+    return moment
+
+
+def main(argv=None):
+    global BACKUP_DIR
+    parser = argparse.ArgumentParser(description="Back up and restore telehabit user data.")
+    parser.add_argument('--backup-dir', default=None, help="Backup directory (default: %s)" % BACKUP_DIR)
+    parser.add_argument('--data-file', default=None, help="User data file, unless TELEHABIT_STORAGE_RING is set (default: %s)" % data_manager.DATA_FILE)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('create', help="Take an incremental backup")
+    commands.add_parser('list', help="List backups")
+    restore_parser = commands.add_parser('restore', help="Restore user data to a point in time")
+    restore_parser.add_argument('--at', type=_parse_time, default=None,
+                                help="ISO timestamp to restore to (default: latest backup)")
+    restore_parser.add_argument('--output', default=None,
+                                help="Write restored data here instead of the data file")
+    args = parser.parse_args(argv)
+
+    if args.backup_dir:
+        BACKUP_DIR = args.backup_dir
+    if args.data_file:
+        data_manager.DATA_FILE = args.data_file
+
+    if args.command == 'create':
+        for node_id, manifest in create_backups():
+            prefix = "" if node_id is None else f"Node {node_id}: "
+            if manifest is None:
+                print(f"{prefix}No changes since the last backup.")
+            else:
+                print(f"{prefix}Backup {manifest['backup_id']}: {len(manifest['changed'])} changed, "
+                      f"{len(manifest['removed'])} removed users.")
+    elif args.command == 'list':
+        node_ids = [None] if data_manager.STORE is None else backed_up_node_ids()
+        for node_id in node_ids:
+            if node_id is not None:
+                print(f"Node {node_id}:")
+            for manifest in list_backups(node_id):
+                print(f"{manifest['backup_id']}  {manifest['created_at']}  "
+                      f"{len(manifest['changed'])} changed, {len(manifest['removed'])} removed")
+    elif args.command == 'restore':
+        try:
+            users = restore(args.at, args.output)
+        except LookupError as e:
+            parser.exit(1, f"{e}\n")
+        print(f"Restored {len(users)} users.")
+
+
+if __name__ == '__main__':
+    main()
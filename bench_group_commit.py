@@ -0,0 +1,70 @@
+"""Measures update throughput as concurrency rises, with and without group commit.
+
+Each level starts N threads that each perform a fixed number of update_user
+style writes against a scratch data file. "single" persists every update on
+its own (max_batch=1); "group" uses the configured commit window and batch.
+
+Usage:
+    python bench_group_commit.py [--users 1000] [--updates 20] [--window 0.002] [--max-batch 256]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import data_manager
+
+
+def run_level(writer, threads, updates_per_thread, users):
+    """Returns (updates per second, writes performed) for one concurrency level."""
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(n):
+        barrier.wait()
+        for i in range(updates_per_thread):
+            writer.submit(f"user_{(n * updates_per_thread + i) % users}", {'gold': i}).result()
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in pool:
+        t.start()
+    batches_before = writer.batches
+    barrier.wait()
+    start = time.perf_counter()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return threads * updates_per_thread / elapsed, writer.batches - batches_before
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000, help="Users in the scratch data file")
+    parser.add_argument('--updates', type=int, default=20, help="Updates per thread")
+    parser.add_argument('--window', type=float, default=data_manager.GROUP_COMMIT_WINDOW)
+    parser.add_argument('--max-batch', type=int, default=data_manager.GROUP_COMMIT_MAX_BATCH)
+    parser.add_argument('--levels', default='1,2,4,8,16,32,64', help="Comma-separated thread counts")
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp()
+    original_data_file = data_manager.DATA_FILE
+    data_manager.DATA_FILE = os.path.join(scratch, 'user_data.json')
+    try:
+        data_manager.save_user_data({f"user_{i}": {"health": 100, "experience": 0, "gold": 10, "tasks": {}, "habits": {}}
+                                     for i in range(args.users)})
+        single = data_manager.GroupCommitWriter(window=0, max_batch=1)
+        group = data_manager.GroupCommitWriter(window=args.window, max_batch=args.max_batch)
+
+        print(f"{'threads':>7}  {'single upd/s':>12}  {'group upd/s':>11}  {'writes':>6}  {'speedup':>7}")
+        for threads in (int(level) for level in args.levels.split(',')):
+            single_rate, _ = run_level(single, threads, args.updates, args.users)
+            group_rate, writes = run_level(group, threads, args.updates, args.users)
+            print(f"{threads:>7}  {single_rate:>12.0f}  {group_rate:>11.0f}  {writes:>6}  {group_rate / single_rate:>6.1f}x")
+    finally:
+        data_manager.DATA_FILE = original_data_file
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,81 @@
+import asyncio
+import contextlib
+import heapq
 import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from events import hub, diff_user
+from quotas import usage
+import rules
 
 DATA_FILE = 'user_data.json' # Module-level variable
 
-def load_user_data():
-    """Loads user data from the JSON file."""
+# Group commit tuning: how long the writer waits for more updates to join a
+# batch (seconds), and the most updates persisted by one write.
+GROUP_COMMIT_WINDOW = float(os.environ.get('TELEHABIT_GROUP_COMMIT_WINDOW', '0.002'))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('TELEHABIT_GROUP_COMMIT_MAX_BATCH', '256'))
+
+# Ring file listing the storage nodes to partition users across (see
+# partitioning.py). Empty means the single DATA_FILE.
+STORAGE_RING = os.environ.get('TELEHABIT_STORAGE_RING', '')
+STORE = None # partitioning.PartitionedStore when STORAGE_RING is set
+
+# Seconds between checks for changes written by other processes (e.g. the bot)
+# to users with an open event stream.
+EXTERNAL_UPDATE_POLL_INTERVAL = float(os.environ.get('TELEHABIT_EXTERNAL_UPDATE_POLL_INTERVAL', '1.0'))
+
+logger = logging.getLogger(__name__)
+
+def load_data_file(path):
+    """Loads user data from a JSON file, or {} if it is missing or invalid."""
     try:
-        with open(DATA_FILE, 'r') as f: # Uses module-level DATA_FILE
+        with open(path, 'r') as f:
             data = json.load(f)
     except (FileNotFoundError, json.JSONDecodeError):
         data = {}
     return data
 
+def save_data_file(path, data):
+    """Saves user data to a JSON file.
+
+    The data is written and fsynced to a temporary file which then replaces
+    the file, so readers (including backups) never see a partially written
+    file and the data is durable once this returns.
+    """
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+def load_user_data():
+    """Loads user data from the JSON file."""
+    return load_data_file(DATA_FILE) # Uses module-level DATA_FILE
+
 def save_user_data(data):
     """Saves user data to the JSON file."""
-    with open(DATA_FILE, 'w') as f: # Uses module-level DATA_FILE
-        json.dump(data, f, indent=4)
+    save_data_file(DATA_FILE, data) # Uses module-level DATA_FILE
 
 def get_user(user_id):
     """Gets a specific user's data, initializing if not found."""
-    users = load_user_data()
     user_id_str = str(user_id)
+    if STORE is not None:
+        users = {}
+        user_data = STORE.get_user(user_id_str) # Only this user's partition is read
+        if user_data is not None:
+            users[user_id_str] = user_data
+    else:
+        users = load_user_data()
     if user_id_str not in users:
         users[user_id_str] = {"health": 100, "experience": 0, "gold": 10, "tasks": {}, "habits": {}}
         # No need to save here, as get_user is for retrieval.
@@ -27,13 +83,317 @@ def get_user(user_id):
     return users.get(user_id_str)
 
 
-def update_user(user_id, user_specific_data):
-    """Updates a specific user's data."""
-    users = load_user_data()
-    user_id_str = str(user_id)
+def apply_update(users, user_id_str, user_specific_data):
+    """Merges one update into the loaded users. Returns (previous, updated) records."""
     # Ensure the user exists before updating, or initialize if that's the desired behavior.
-    # For now, assuming get_user or some other mechanism ensures user creation.
     if user_id_str not in users:
         users[user_id_str] = {"health": 100, "experience": 0, "gold": 10, "tasks": {}, "habits": {}} # Initialize if not exist
+    previous = dict(users[user_id_str])
     users[user_id_str].update(user_specific_data)
-    save_user_data(users)
+    users[user_id_str]['version'] = previous.get('version', 0) + 1
+    # Snapshot: a later update to the same user in one batch mutates the stored record.
+    return previous, dict(users[user_id_str])
+
+
+def apply_bulk_update(users, deltas, user_ids=None):
+    """Applies rules deltas to many loaded users (default: all), bumping each one's version.
+
+    Returns {user_id: (previous, updated)} for the users that were updated.
+    """
+    if user_ids is None:
+        user_ids = list(users)
+    previous = {str(user_id): dict(users[str(user_id)]) for user_id in user_ids if str(user_id) in users}
+    changes = {}
+    for user_id_str in rules.apply_bulk(users, deltas, list(previous)):
+        users[user_id_str]['version'] = previous[user_id_str].get('version', 0) + 1
+        changes[user_id_str] = (previous[user_id_str], dict(users[user_id_str]))
+    return changes
+
+
+class GroupCommitWriter:
+    """Coalesces concurrent writes into a single load, write and fsync.
+
+    Writes are queued by submit() or submit_op(); one background thread drains
+    everything pending (waiting up to `window` seconds for stragglers, at most
+    `max_batch` writes), applies the batch in order to one load of the data,
+    saves it once and only then resolves each write's Future.
+
+    load and save default to load_user_data/save_user_data; storage nodes
+    pass their own to commit to a different file, and a lock (a context
+    manager factory) held around each load-apply-save so that writers in
+    other processes cannot interleave with it.
+    """
+
+    def __init__(self, window=None, max_batch=None, load=None, save=None, lock=None):
+        self.window = GROUP_COMMIT_WINDOW if window is None else window
+        self.max_batch = GROUP_COMMIT_MAX_BATCH if max_batch is None else max_batch
+        self.batches = 0 # Number of writes performed, for monitoring and benchmarks
+        self._load = load
+        self._save = save
+        self._lock = lock or contextlib.nullcontext
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, user_id, user_specific_data):
+        """Queues a user update. The Future resolves to (previous, updated) records once durable."""
+        user_id_str = str(user_id)
+        return self.submit_op(lambda users: apply_update(users, user_id_str, user_specific_data))
+
+    def submit_op(self, op):
+        """Queues op(users), which mutates the loaded data in place.
+
+        The Future resolves to op's return value once the batch is durable, or
+        to the exception op raised. A failed op leaves no trace, even if it
+        mutated the data before raising; other writes in the batch still commit.
+        """
+        future = Future()
+        self._ensure_started()
+        self._queue.put((op, future))
+        return future
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()] # Block until there is work
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._commit(batch)
+            except BaseException as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _commit(self, batch):
+        with self._lock():
+            self._commit_locked(batch)
+
+    def _commit_locked(self, batch):
+        pending = batch
+        while True:
+            users = (self._load or load_user_data)()
+            outcomes = []
+            failed = False
+            for op, future in pending:
+                try:
+                    outcomes.append((future, op(users)))
+                except Exception as e:
+                    future.set_exception(e)
+                    failed = True
+            if not failed:
+                break
+            # A failed op may have changed users before raising: reload and
+            # re-apply the rest of the batch without it (rare, so the common
+            # path stays a single load).
+            pending = [(op, future) for op, future in pending if not future.done()]
+            if not pending:
+                return
+        (self._save or save_user_data)(users)
+        self.batches += 1
+
+        for future, result in outcomes:
+            future.set_result(result)
+
+
+writer = GroupCommitWriter()
+
+
+class ExternalUpdateWatcher:
+    """Publishes changes that other processes wrote to users with live subscribers.
+
+    The event hub only sees updates made in this process, but the bot and the
+    web app usually run as separate processes sharing the same storage. While
+    anyone is subscribed, a background thread polls the stored records of the
+    subscribed users (re-reading the data file only when it was replaced) and
+    publishes a diff whenever a user's version moved past the last one seen.
+    In-process updates go through observe() too, so nothing is published twice.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = EXTERNAL_UPDATE_POLL_INTERVAL if interval is None else interval
+        self._last_seen = {} # user id -> last record published (or used as a baseline)
+        self._data_file_stamp = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def observe(self, user_id_str, record, baseline=None):
+        """Publishes what changed in record since the last version seen for the user.
+
+        baseline is the record to diff against when the user has not been seen
+        yet; without one, record only becomes the baseline.
+        """
+        with self._lock:
+            last = self._last_seen.get(user_id_str, baseline)
+            if last is not None and record.get('version', 0) <= last.get('version', 0):
+                return # Already published (versions only move forward)
+            self._last_seen[user_id_str] = record
+            if last is not None:
+                changes = diff_user(last, record)
+                if changes:
+                    # Still under the lock (publish never blocks), so concurrent
+                    # observers publish a user's changes in version order.
+                    hub.publish(user_id_str, changes)
+
+    def _stored_records(self, user_ids):
+        if STORE is not None:
+            return {user_id: STORE.get_user(user_id) for user_id in user_ids}
+        try:
+            stat = os.stat(DATA_FILE)
+        except FileNotFoundError:
+            return {}
+        stamp = (stat.st_mtime_ns, stat.st_ino) # save_data_file replaces the file
+        with self._lock:
+            unchanged = stamp == self._data_file_stamp and all(user_id in self._last_seen for user_id in user_ids)
+            self._data_file_stamp = stamp
+        if unchanged:
+            return {}
+        users = load_user_data()
+        return {user_id: users.get(user_id) for user_id in user_ids}
+
+    def poll(self):
+        """Checks subscribed users once for changes made outside this process."""
+        user_ids = hub.subscribed_users()
+        with self._lock:
+            # Forget users nobody watches any more, so memory follows open streams.
+            self._last_seen = {user_id: record for user_id, record in self._last_seen.items() if user_id in user_ids}
+        if not user_ids:
+            return
+        for user_id, record in self._stored_records(user_ids).items():
+            if record is not None:
+                self.observe(user_id, record)
+
+    def ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='external-update-watcher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Polling for external updates failed")
+
+
+watcher = ExternalUpdateWatcher()
+
+
+def _notify_update(user_id_str, previous, updated):
+    usage.record(user_id_str, updated) # Keep per-user size tracking current
+    # Push what changed to any live clients (web app event streams).
+    if hub.has_subscribers(user_id_str):
+        watcher.observe(user_id_str, updated, baseline=previous)
+
+
+def update_user(user_id, user_specific_data):
+    """Updates a specific user's data and returns the stored result.
+
+    Blocks until the change is durable. Concurrent updates are persisted
+    together by the group-commit writer. Every update bumps the user's
+    'version', which caches use to tell whether anything changed.
+    """
+    user_id_str = str(user_id)
+    if STORE is not None:
+        previous, updated = STORE.update_user(user_id_str, user_specific_data)
+    else:
+        previous, updated = writer.submit(user_id_str, user_specific_data).result()
+    _notify_update(user_id_str, previous, updated)
+    return updated
+
+
+async def update_user_async(user_id, user_specific_data):
+    """Like update_user, but awaits durability instead of blocking the event loop."""
+    user_id_str = str(user_id)
+    if STORE is not None:
+        previous, updated = await asyncio.to_thread(STORE.update_user, user_id_str, user_specific_data)
+    else:
+        previous, updated = await asyncio.wrap_future(writer.submit(user_id_str, user_specific_data))
+    _notify_update(user_id_str, previous, updated)
+    return updated
+
+
+# --- Admin scans (run in parallel across partitions when STORE is set) ---
+
+def all_users():
+    """Returns every user's data."""
+    if STORE is not None:
+        return STORE.all_users()
+    return load_user_data()
+
+
+def leaderboard(stat='experience', limit=10):
+    """Returns [(user_id, value)] for the users with the highest value of a stat."""
+    if STORE is not None:
+        return STORE.leaderboard(stat, limit)
+    return top_users(load_user_data(), stat, limit)
+
+
+def top_users(users, stat, limit):
+    return heapq.nlargest(limit, ((user_id, user_data.get(stat, 0)) for user_id, user_data in users.items()),
+                          key=lambda entry: entry[1])
+
+
+def apply_bulk(deltas, user_ids=None):
+    """Durably applies rules deltas to many users (default: all), e.g. for a sweep.
+
+    Like update_user, every updated user's version is bumped and its change
+    is reported to size tracking and live clients. Returns the ids of the
+    users that were updated.
+    """
+    if STORE is not None:
+        changes = STORE.apply_bulk(deltas, user_ids)
+    else:
+        changes = writer.submit_op(lambda users: apply_bulk_update(users, deltas, user_ids)).result()
+    for user_id_str, (previous, updated) in changes.items():
+        _notify_update(user_id_str, previous, updated)
+    return list(changes)
+
+
+def configure_storage(node_specs=(), ring_file=None):
+    """Partitions users across storage nodes, given by a ring file or as node specs.
+
+    See partitioning.store_from_ring and partitioning.node_from_spec; neither
+    disables partitioning.
+    """
+    global STORE
+    from partitioning import PartitionedStore, node_from_spec, store_from_ring # Imported here: partitioning imports this module
+    specs = [spec.strip() for spec in node_specs if spec.strip()]
+    if ring_file:
+        STORE = store_from_ring(ring_file)
+    elif specs:
+        STORE = PartitionedStore([node_from_spec(spec) for spec in specs])
+    else:
+        STORE = None
+    return STORE
+
+
+if STORAGE_RING:
+    configure_storage(ring_file=STORAGE_RING)
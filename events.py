@@ -0,0 +1,91 @@
+import queue
+import threading
+
+STAT_FIELDS = ("health", "experience", "gold")
+COLLECTION_FIELDS = ("tasks", "habits")
+
+
+class EventHub:
+    """In-process pub/sub hub that fans out per-user change events.
+
+    Every subscriber gets its own bounded queue. A subscriber that stops
+    draining its queue loses its oldest events instead of blocking publishers.
+    """
+
+    def __init__(self, max_queue_size=100):
+        self.max_queue_size = max_queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        """Registers a new subscriber for a user and returns its queue."""
+        q = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            self._subscribers.setdefault(str(user_id), []).append(q)
+        return q
+
+    def unsubscribe(self, user_id, q):
+        """Removes a subscriber queue. Unknown queues are ignored."""
+        user_id_str = str(user_id)
+        with self._lock:
+            queues = self._subscribers.get(user_id_str, [])
+            if q in queues:
+                queues.remove(q)
+            if not queues:
+                self._subscribers.pop(user_id_str, None)
+
+    def has_subscribers(self, user_id):
+        with self._lock:
+            return bool(self._subscribers.get(str(user_id)))
+
+    def subscribed_users(self):
+        """Returns the ids of users that currently have at least one subscriber."""
+        with self._lock:
+            return list(self._subscribers)
+
+    def publish(self, user_id, event):
+        """Delivers an event to every subscriber of a user without blocking."""
+        with self._lock:
+            queues = list(self._subscribers.get(str(user_id), []))
+        for q in queues:
+            while True:
+                try:
+                    q.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait() # Drop the oldest event to make room
+                    except queue.Empty:
+                        pass
+
+
+def diff_user(old, new):
+    """Builds an incremental change event between two versions of a user's data.
+
+    Returns an empty dict when nothing visible to clients has changed.
+    """
+    old = old or {}
+    event = {}
+
+    stats = {field: new[field] for field in STAT_FIELDS
+             if field in new and new[field] != old.get(field)}
+    if stats:
+        event["stats"] = stats
+
+    for field in COLLECTION_FIELDS:
+        old_items = old.get(field) or {}
+        new_items = new.get(field) or {}
+        changed = {name: item for name, item in new_items.items()
+                   if old_items.get(name) != item}
+        removed = [name for name in old_items if name not in new_items]
+        if changed:
+            event[field] = changed
+        if removed:
+            event["removed_" + field] = removed
+
+    return event
+
+
+# Shared by everything in this process. Changes written by other processes
+# (e.g. the bot) are picked up by data_manager.ExternalUpdateWatcher.
+hub = EventHub()
@@ -1,6 +1,7 @@
 import logging
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes
 
 # Enable logging
 logging.basicConfig(
@@ -10,7 +11,10 @@ logger = logging.getLogger(__name__)
 
 # Define a few command handlers. These usually take the two arguments update and
 # context.
-from data_manager import get_user, update_user
+from data_manager import get_user, update_user_async
+import rules
+import status_panel
+import traffic
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
@@ -34,11 +38,11 @@ async def complete_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Future enhancement: check if task_name is in user_data['tasks']
     # and perhaps remove it or mark it as completed.
 
-    user_data['experience'] += 10
-    user_data['gold'] += 5
-    update_user(user_id, user_data)
+    rules.apply_deltas(user_data, rules.TASK_COMPLETED)
+    await update_user_async(user_id, user_data)
 
-    await update.message.reply_text(f"You completed '{task_name}'! You gained 10 XP and 5 Gold.")
+    reward = rules.TASK_COMPLETED
+    await update.message.reply_text(f"You completed '{task_name}'! You gained {reward['experience']} XP and {reward['gold']} Gold.")
 
 async def failed_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the /failed_task command."""
@@ -51,26 +55,58 @@ async def failed_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     task_name = " ".join(context.args)
 
-    user_data['health'] -= 10
-    update_user(user_id, user_data)
+    rules.apply_deltas(user_data, rules.TASK_FAILED)
+    await update_user_async(user_id, user_data)
 
-    await update.message.reply_text(f"You reported failing '{task_name}'. You lost 10 Health.")
+    await update.message.reply_text(f"You reported failing '{task_name}'. You lost {-rules.TASK_FAILED['health']} Health.")
 
     if user_data['health'] <= 0:
         await update.message.reply_text("Your health has reached 0! Be careful!")
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Displays the user's current status."""
+    """Sends the user's status panel, which later taps edit in place."""
     user_id = update.effective_user.id
     user_data = get_user(user_id)
 
-    status_message = (
-        f"Your Status:\n"
-        f"Health: {user_data['health']}\n"
-        f"Experience: {user_data['experience']}\n"
-        f"Gold: {user_data['gold']}"
-    )
-    await update.message.reply_text(text=status_message)
+    text, keyboard = status_panel.render_cache.render(user_id, user_data)
+    await update.message.reply_text(text=text, reply_markup=keyboard)
+
+async def status_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles taps on the status panel's buttons by editing the panel message."""
+    query = update.callback_query
+    parsed = status_panel.parse_callback_data(query.data or '')
+    if parsed is None:
+        await query.answer()
+        return
+    action, shown_version, task_name = parsed
+
+    user_id = query.from_user.id
+    user_data = get_user(user_id)
+    notice = None
+
+    if action == status_panel.ACTION_COMPLETE:
+        task = user_data.get('tasks', {}).get(task_name)
+        if task is not None and not task.get('completed'):
+            task['completed'] = True
+            rules.apply_deltas(user_data, rules.TASK_COMPLETED)
+            user_data = await update_user_async(user_id, user_data)
+            reward = rules.TASK_COMPLETED
+            notice = f"Completed '{task_name}': +{reward['experience']} XP, +{reward['gold']} Gold"
+        else:
+            notice = "That task is already done or no longer exists."
+
+    # Nothing changed since the panel was drawn: skip re-rendering and the edit.
+    if status_panel.data_version(user_data) == shown_version:
+        await query.answer(notice or "Already up to date.")
+        return
+
+    await query.answer(notice)
+    text, keyboard = status_panel.render_cache.render(user_id, user_data)
+    try:
+        await query.edit_message_text(text=text, reply_markup=keyboard)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
 
 import os
 
@@ -82,26 +118,29 @@ def main() -> None:
         raise ValueError("Please set the TELEGRAM_TOKEN environment variable")
     application = Application.builder().token(token).build()
 
+    # Record sanitized commands for replay when TELEHABIT_CAPTURE_FILE is set.
+    capture = traffic.capture_from_env()
+    bot_capture = traffic.BotCapture(*capture) if capture else None
+    def handler(command, callback):
+        return bot_capture.wrap(command, callback) if bot_capture else callback
+
     # on different commands - answer in Telegram
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("complete_task", complete_task))
-    application.add_handler(CommandHandler("failed_task", failed_task))
-    application.add_handler(CommandHandler("status", status))
-    application.add_handler(CommandHandler("webapp", webapp_command_handler))
+    application.add_handler(CommandHandler("start", handler("start", start)))
+    application.add_handler(CommandHandler("complete_task", handler("complete_task", complete_task)))
+    application.add_handler(CommandHandler("failed_task", handler("failed_task", failed_task)))
+    application.add_handler(CommandHandler("status", handler("status", status)))
+    application.add_handler(CommandHandler("webapp", handler("webapp", webapp_command_handler)))
+    application.add_handler(CallbackQueryHandler(handler("callback", status_panel_callback),
+                                                 pattern=f"^{status_panel.CALLBACK_PREFIX}:"))
 
     # Run the bot until the user presses Ctrl-C
     application.run_polling()
 
 async def webapp_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    # Make sure your Flask app is running on port 5000 locally
-    webapp_url = f'http://127.0.0.1:5000/webapp?user_id={user_id}'
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Open Tasks & Habits", url=webapp_url)]
-    ])
     await update.message.reply_text(
         "Click below to manage your tasks and habits:",
-        reply_markup=keyboard
+        reply_markup=status_panel.webapp_keyboard(user_id)
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,755 @@
+"""Consistent-hash partitioning of users across storage nodes.
+
+A storage node is either a local directory (LocalNode) or a worker process
+serving a directory over a small line-delimited JSON protocol on TCP
+(RemoteNode / serve). PartitionedStore routes every user to one node with a
+hash ring, moves users when a node is added, and runs admin scans on all
+nodes in parallel.
+
+The nodes are listed in a ring file that every process (app and bot) reads
+at startup and re-reads whenever it changes. Set TELEHABIT_STORAGE_RING to
+enable it, e.g.
+    TELEHABIT_STORAGE_RING=storage_ring.json python app.py
+
+Usage:
+    python partitioning.py serve --dir nodes/b --port 7001
+    python partitioning.py init --ring storage_ring.json nodes/a tcp://127.0.0.1:7001
+    python partitioning.py reshard --ring storage_ring.json [--add nodes/c]
+
+reshard runs while the app and bot keep serving; without --add it finishes an
+interrupted reshard.
+"""
+import argparse
+import bisect
+import contextlib
+import hashlib
+import heapq
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError: # Windows: a node directory is then only safe to use from one process
+    fcntl = None
+
+import data_manager
+
+VIRTUAL_NODES = 64 # Points per node on the ring; more points spread users more evenly
+LOCK_STRIPES = 64
+RESHARD_BATCH_SIZE = 100
+NODE_ID_FILE = 'node_id' # In each node's directory; the node's identity on the ring
+RESHARD_GRACE = 2.0 # Seconds reshard waits after changing the ring file, so requests routed by the old ring finish
+MOVE_RETRIES = 3
+MOVING = '_moving' # Marks a stored record being copied to its new node; it is read-only meanwhile
+MOVED = '_moved' # A stored tombstone: the user now lives on another node
+
+
+class StorageNodeError(RuntimeError):
+    """Raised when a remote storage node reports an error."""
+
+
+class UserMovedError(StorageNodeError):
+    """Raised when writing a user that is moving, or has moved, to another node."""
+
+
+@contextlib.contextmanager
+def _file_lock(path, blocking=True):
+    """Holds an exclusive lock on path, shared with other processes (see fcntl.flock)."""
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise StorageNodeError(f"{path} is locked by another process")
+        yield # Closing the file releases the lock
+
+
+def _visible(record):
+    """A stored record as callers see it: None for a tombstone, without its move mark."""
+    if record is None or record.get(MOVED):
+        return None
+    if MOVING in record:
+        return {key: value for key, value in record.items() if key != MOVING}
+    return record
+
+
+def _visible_users(users):
+    return {user_id: _visible(record) for user_id, record in users.items() if not record.get(MOVED)}
+
+
+def _check_writable(user_id, record):
+    if record is not None and (record.get(MOVING) or record.get(MOVED)):
+        raise UserMovedError(f"User {user_id} is moving to another node")
+
+
+def _ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Maps keys to node names so that adding a node only moves about 1/N keys."""
+
+    def __init__(self, node_names, vnodes=VIRTUAL_NODES):
+        if not node_names:
+            raise ValueError("A hash ring needs at least one node")
+        self.node_names = list(node_names)
+        points = sorted((_ring_hash(f"{name}#{i}"), name) for name in self.node_names for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, _ring_hash(str(key))) % len(self._hashes)
+        return self._names[index]
+
+
+def _read_or_create_node_id(directory, expected_id=None):
+    """Returns the id stored in a node directory, creating one for a new node.
+
+    With expected_id, the directory must already hold that id: a missing id
+    file means the node was moved or never set up, and routing users with a
+    fresh id would silently send them to the wrong node.
+    """
+    path = os.path.join(directory, NODE_ID_FILE)
+    try:
+        with open(path, 'r') as f:
+            node_id = f.read().strip()
+    except FileNotFoundError:
+        if expected_id is not None:
+            raise StorageNodeError(f"{directory} has no {NODE_ID_FILE} file, expected node {expected_id}")
+        node_id = uuid.uuid4().hex
+        try:
+            with open(path, 'x') as f: # Exclusive: two processes cannot both create one
+                f.write(node_id + '\n')
+        except FileExistsError:
+            return _read_or_create_node_id(directory, expected_id)
+    if expected_id is not None and node_id != expected_id:
+        raise StorageNodeError(f"{directory} holds node {node_id}, expected node {expected_id}")
+    return node_id
+
+
+class LocalNode:
+    """A storage node backed by user_data.json in a local directory.
+
+    The node's name (its position on the hash ring) is the id stored in the
+    directory's node_id file, so it does not depend on how the path is
+    spelled or where the directory lives. Writes go through the node's own
+    group-commit writer, which holds a file lock while committing so that
+    every process opening the directory writes atomically.
+
+    Users moving to another node are first frozen (kept, but read-only), then
+    replaced by a tombstone once their new node has them; readers never see
+    either mark, and writes to such users raise UserMovedError.
+    """
+
+    def __init__(self, directory, window=None, max_batch=None, node_id=None):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.name = _read_or_create_node_id(self.directory, node_id)
+        self.path = os.path.join(self.directory, 'user_data.json')
+        self.writer = data_manager.GroupCommitWriter(
+            window, max_batch,
+            load=lambda: data_manager.load_data_file(self.path),
+            save=lambda data: data_manager.save_data_file(self.path, data),
+            lock=lambda: _file_lock(os.path.join(self.directory, 'user_data.lock')))
+
+    def _write(self, op):
+        return self.writer.submit_op(op).result()
+
+    def node_id(self):
+        return self.name
+
+    def get_user(self, user_id):
+        return _visible(data_manager.load_data_file(self.path).get(user_id))
+
+    def get_users(self, user_ids):
+        users = _visible_users(data_manager.load_data_file(self.path))
+        return {user_id: users[user_id] for user_id in user_ids if user_id in users}
+
+    def user_ids(self):
+        return list(_visible_users(data_manager.load_data_file(self.path)))
+
+    def load_all(self):
+        return _visible_users(data_manager.load_data_file(self.path))
+
+    def top(self, stat, limit):
+        return data_manager.top_users(self.load_all(), stat, limit)
+
+    def update_user(self, user_id, user_specific_data):
+        user_id = str(user_id)
+
+        def update(users):
+            _check_writable(user_id, users.get(user_id))
+            return data_manager.apply_update(users, user_id, user_specific_data)
+        return self._write(update)
+
+    def freeze_users(self, user_ids):
+        """Marks users as moving and returns their records; users already frozen are returned again."""
+        def freeze(users):
+            frozen = {}
+            for user_id in user_ids:
+                record = users.get(user_id)
+                if record is not None and not record.get(MOVED):
+                    record[MOVING] = True
+                    frozen[user_id] = _visible(record)
+            return frozen
+        return self._write(freeze)
+
+    def put_users_if_absent(self, records):
+        """Stores the records of users this node does not have. Returns the ids stored."""
+        def put(users):
+            stored = []
+            for user_id, record in records.items():
+                if _visible(users.get(user_id)) is None:
+                    users[user_id] = record
+                    stored.append(user_id)
+            return stored
+        return self._write(put)
+
+    def retire_users(self, user_ids):
+        """Replaces frozen users by tombstones, once their new node has them."""
+        def retire(users):
+            for user_id in user_ids:
+                if users.get(user_id, {}).get(MOVING):
+                    users[user_id] = {MOVED: True}
+        self._write(retire)
+
+    def purge_moved(self):
+        """Drops tombstones, once no process routes users by the old ring. Returns how many."""
+        def purge(users):
+            moved = [user_id for user_id, record in users.items() if record.get(MOVED)]
+            for user_id in moved:
+                del users[user_id]
+            return len(moved)
+        return self._write(purge)
+
+    def apply_bulk(self, deltas, user_ids=None):
+        def apply(users):
+            targets = [user_id for user_id in (users if user_ids is None else map(str, user_ids))
+                       if user_id in users and not users[user_id].get(MOVED)]
+            for user_id in targets:
+                _check_writable(user_id, users[user_id])
+            return data_manager.apply_bulk_update(users, deltas, targets)
+        return self._write(apply)
+
+    def replace_all(self, records):
+        def replace(users):
+            users.clear()
+            users.update(records)
+        self._write(replace)
+
+
+# Operations a worker process exposes over RPC.
+NODE_OPERATIONS = ('node_id', 'get_user', 'get_users', 'user_ids', 'load_all', 'top', 'update_user',
+                   'freeze_users', 'put_users_if_absent', 'retire_users', 'purge_moved', 'apply_bulk',
+                   'replace_all')
+
+
+class RemoteNode:
+    """Client for a storage node served by another process (see NodeServer).
+
+    The node's name is the id of the directory the worker serves, asked for
+    once, so it does not depend on how the address is written. With node_id,
+    every connection checks that the worker still serves that node.
+    """
+
+    def __init__(self, host, port, node_id=None):
+        self.host = host
+        self.port = int(port)
+        self.address = f"tcp://{host}:{self.port}"
+        self._expected_id = node_id
+        self._name = node_id
+        self._local = threading.local() # One connection per calling thread
+
+    @property
+    def name(self):
+        if self._name is None:
+            self._name = self._call('node_id')
+        return self._name
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port))
+            conn = self._local.conn = (sock, sock.makefile('rwb'))
+            if self._expected_id is not None:
+                served_id = self._call('node_id')
+                if served_id != self._expected_id:
+                    self._local.conn = None
+                    sock.close()
+                    raise StorageNodeError(f"{self.address} serves node {served_id}, expected node {self._expected_id}")
+        return conn
+
+    def _call(self, op, *args):
+        request = json.dumps({"op": op, "args": args}).encode('utf-8') + b'\n'
+        try:
+            sock, stream = self._connection()
+            stream.write(request)
+            stream.flush()
+            line = stream.readline()
+            if not line:
+                raise ConnectionError("Storage node closed the connection")
+        except OSError:
+            self._local.conn = None # Reconnect on the next call
+            raise
+        response = json.loads(line)
+        if not response["ok"]:
+            error = UserMovedError if response.get("type") == UserMovedError.__name__ else StorageNodeError
+            raise error(f"{self.address}: {response['error']}")
+        return response["result"]
+
+    def get_user(self, user_id):
+        return self._call('get_user', user_id)
+
+    def get_users(self, user_ids):
+        return self._call('get_users', user_ids)
+
+    def user_ids(self):
+        return self._call('user_ids')
+
+    def load_all(self):
+        return self._call('load_all')
+
+    def top(self, stat, limit):
+        return [tuple(entry) for entry in self._call('top', stat, limit)]
+
+    def update_user(self, user_id, user_specific_data):
+        previous, updated = self._call('update_user', user_id, user_specific_data)
+        return previous, updated
+
+    def freeze_users(self, user_ids):
+        return self._call('freeze_users', user_ids)
+
+    def put_users_if_absent(self, records):
+        return self._call('put_users_if_absent', records)
+
+    def retire_users(self, user_ids):
+        self._call('retire_users', user_ids)
+
+    def purge_moved(self):
+        return self._call('purge_moved')
+
+    def apply_bulk(self, deltas, user_ids=None):
+        return self._call('apply_bulk', deltas, user_ids)
+
+    def replace_all(self, records):
+        self._call('replace_all', records)
+
+
+def node_from_spec(spec, node_id=None):
+    """Builds a node from 'tcp://host:port' (RemoteNode) or a directory path (LocalNode).
+
+    node_id, if given, is the id the node must have (see LocalNode and RemoteNode).
+    """
+    if spec.startswith('tcp://'):
+        host, _, port = spec[len('tcp://'):].rpartition(':')
+        return RemoteNode(host, port, node_id=node_id)
+    return LocalNode(spec, node_id=node_id)
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class PartitionedStore:
+    """Routes users to storage nodes by consistent hashing.
+
+    Adding a node moves users online. While they move, a user is read from
+    its new node, else from its old one, and a write first finishes the
+    user's move; every step of a move (see _move) can be repeated by any
+    process, so the mover and requests in other processes never lose or
+    overwrite each other's data. Per-user operations also hold a lock stripe
+    for the user, so within a process they do not race with the mover at all.
+
+    With ring_file, the store re-reads the ring file whenever it changes, so
+    a reshard run by another process (see reshard) is picked up.
+    """
+
+    def __init__(self, nodes, vnodes=VIRTUAL_NODES, moving_from=None, ring_file=None):
+        self.vnodes = vnodes
+        self._nodes = {node.name: node for node in nodes}
+        self._ring = HashRing(list(self._nodes), vnodes)
+        # Set while users are moving to a new node: the node names before it was added.
+        self._previous_ring = HashRing(moving_from, vnodes) if moving_from else None
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._reshard_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(thread_name_prefix='partition-scan')
+        self.ring_file = ring_file
+        self._ring_stamp = None # Unknown, so the first access re-reads the ring file
+        self._reload_lock = threading.Lock()
+
+    @property
+    def nodes(self):
+        return list(self._nodes.values())
+
+    def node_for(self, user_id):
+        return self._nodes[self._ring.node_for(user_id)]
+
+    def _stripe_index(self, user_id):
+        return zlib.crc32(str(user_id).encode('utf-8')) % LOCK_STRIPES
+
+    def _refresh_ring(self):
+        """Re-reads the ring file if another process changed it. Must not hold a lock stripe."""
+        if self.ring_file is None:
+            return
+        stamp = _file_stamp(self.ring_file)
+        if stamp == self._ring_stamp:
+            return
+        with self._reload_lock:
+            stamp = _file_stamp(self.ring_file) # Before reading, so a later change is never missed
+            if stamp == self._ring_stamp:
+                return
+            ring = load_ring(self.ring_file)
+            nodes = {node_id: self._nodes.get(node_id) or node_from_spec(_resolve_spec(self.ring_file, spec), node_id)
+                     for node_id, spec in ring["nodes"].items()}
+            moving_from = ring.get("moving_from")
+            self._swap_ring(nodes, HashRing(moving_from, self.vnodes) if moving_from else None)
+            self._ring_stamp = stamp
+
+    def _move(self, source, user_ids):
+        """Moves users from source to the nodes owning them now. Returns the number moved.
+
+        Freezing makes source's copies read-only, so they are safe to copy even
+        if another process is moving the same users; a copy never overwrites a
+        record the owner already has, and source keeps a tombstone so a writer
+        still routing by the old ring fails instead of recreating the user.
+        """
+        records = source.freeze_users(user_ids)
+        by_owner = {}
+        for user_id, record in records.items():
+            by_owner.setdefault(self._ring.node_for(user_id), {})[user_id] = record
+        for owner_name, owned in by_owner.items():
+            self._nodes[owner_name].put_users_if_absent(owned)
+        source.retire_users(list(records))
+        return len(records)
+
+    def _locate(self, user_id):
+        """Returns the node owning a user, first moving it there if a reshard left it behind.
+
+        The caller holds the user's lock stripe.
+        """
+        owner = self.node_for(user_id)
+        previous_ring = self._previous_ring
+        if previous_ring is not None:
+            old = self._nodes[previous_ring.node_for(user_id)]
+            if old is not owner and owner.get_user(user_id) is None:
+                self._move(old, [user_id])
+        return owner
+
+    def get_user(self, user_id):
+        user_id = str(user_id)
+        self._refresh_ring()
+        with self._stripes[self._stripe_index(user_id)]:
+            owner = self.node_for(user_id)
+            record = owner.get_user(user_id)
+            previous_ring = self._previous_ring
+            if record is None and previous_ring is not None:
+                old = self._nodes[previous_ring.node_for(user_id)]
+                if old is not owner:
+                    # Users only move from old to owner: if old no longer has
+                    # the user, another process moved it since the first read.
+                    record = old.get_user(user_id) or owner.get_user(user_id)
+            return record
+
+    def update_user(self, user_id, user_specific_data):
+        """Updates a user on its node. Returns (previous, updated) records."""
+        user_id = str(user_id)
+        for attempt in range(MOVE_RETRIES):
+            self._refresh_ring()
+            with self._stripes[self._stripe_index(user_id)]:
+                try:
+                    previous, updated = self._locate(user_id).update_user(user_id, user_specific_data)
+                    return previous, updated
+                except UserMovedError:
+                    # Routed by a ring that was replaced meanwhile: re-read it and retry.
+                    if attempt == MOVE_RETRIES - 1:
+                        raise
+
+    def _parallel(self, fn, items):
+        return list(self._pool.map(fn, items))
+
+    def _acquire_stripes(self, indexes):
+        for index in sorted(indexes): # Fixed order, so concurrent batches cannot deadlock
+            self._stripes[index].acquire()
+
+    def _release_stripes(self, indexes):
+        for index in indexes:
+            self._stripes[index].release()
+
+    def _swap_ring(self, new_nodes, previous_ring):
+        everything = range(LOCK_STRIPES)
+        self._acquire_stripes(everything) # No per-user operation may straddle the swap
+        try:
+            self._nodes = new_nodes
+            self._ring = HashRing(list(new_nodes), self.vnodes)
+            self._previous_ring = previous_ring
+        finally:
+            self._release_stripes(everything)
+
+    def add_node(self, node, batch_size=RESHARD_BATCH_SIZE):
+        """Adds a storage node and moves the users it now owns, while serving requests.
+
+        For a store used by this process only; see reshard for a ring file.
+        Returns the number of users moved.
+        """
+        with self._reshard_lock:
+            self._swap_ring({**self._nodes, node.name: node}, previous_ring=self._ring)
+            moved = self._finish_move(batch_size)
+        self.purge_moved()
+        return moved
+
+    def resume_reshard(self, batch_size=RESHARD_BATCH_SIZE):
+        """Finishes moving users left behind by an interrupted add_node or reshard.
+
+        Returns the number moved. Tombstones stay until purge_moved.
+        """
+        self._refresh_ring()
+        with self._reshard_lock:
+            if self._previous_ring is None:
+                return 0
+            return self._finish_move(batch_size)
+
+    def purge_moved(self):
+        """Drops the tombstones of moved users from every node. Returns how many."""
+        return sum(self._parallel(lambda node: node.purge_moved(), self.nodes))
+
+    @property
+    def moving_from(self):
+        """Node names before the node being added, or None when no users are moving."""
+        previous_ring = self._previous_ring
+        return None if previous_ring is None else list(previous_ring.node_names)
+
+    def _finish_move(self, batch_size):
+        # If moving fails, the previous ring stays in place so users that were
+        # not moved yet are still found (and moved) on access.
+        moved = self._parallel(lambda source: self._move_misplaced(source, batch_size), self.nodes)
+        self._swap_ring(self._nodes, previous_ring=None)
+        return sum(moved)
+
+    def _move_misplaced(self, source, batch_size):
+        misplaced = [user_id for user_id in source.user_ids() if self._ring.node_for(user_id) != source.name]
+        moved = 0
+        for start in range(0, len(misplaced), batch_size):
+            batch = misplaced[start:start + batch_size]
+            stripes = {self._stripe_index(user_id) for user_id in batch}
+            self._acquire_stripes(stripes)
+            try:
+                # Users accessed since the listing were already moved by _locate
+                # (or by another process) and are skipped.
+                moved += self._move(source, batch)
+            finally:
+                self._release_stripes(stripes)
+        return moved
+
+    # --- Admin scans, run on every node in parallel ---
+
+    def _check_not_moving(self):
+        if self._previous_ring is not None:
+            raise StorageNodeError("Users are moving to a new storage node; retry once the reshard finishes")
+
+    def all_users(self):
+        self._refresh_ring()
+        with self._reshard_lock:
+            users = {}
+            for node_users in self._parallel(lambda node: node.load_all(), self.nodes):
+                for user_id, user in node_users.items():
+                    # Mid-move, a user can be on two nodes; the newest copy wins.
+                    if user_id not in users or user.get('version', 0) > users[user_id].get('version', 0):
+                        users[user_id] = user
+            return users
+
+    def leaderboard(self, stat='experience', limit=10):
+        self._refresh_ring()
+        with self._reshard_lock:
+            tops = self._parallel(lambda node: node.top(stat, limit), self.nodes)
+        best = {}
+        for user_id, value in (entry for top in tops for entry in top): # Mid-move, a user can be on two nodes
+            best[user_id] = max(value, best.get(user_id, value))
+        return heapq.nlargest(limit, best.items(), key=lambda entry: entry[1])
+
+    def apply_bulk(self, deltas, user_ids=None):
+        """Applies rules deltas to many users (default: all) on every node in parallel.
+
+        Returns {user_id: (previous, updated)} like data_manager.apply_bulk_update.
+        Raises StorageNodeError while users are moving to a new node.
+        """
+        self._refresh_ring()
+        with self._reshard_lock:
+            self._check_not_moving()
+            if user_ids is None:
+                work = [(node, None) for node in self.nodes]
+            else:
+                by_owner = {}
+                for user_id in user_ids:
+                    by_owner.setdefault(self._ring.node_for(str(user_id)), []).append(str(user_id))
+                work = [(self._nodes[name], ids) for name, ids in by_owner.items()]
+            results = self._parallel(lambda item: item[0].apply_bulk(deltas, item[1]), work)
+        return {user_id: tuple(change) for changes in results for user_id, change in changes.items()}
+
+    def replace_all(self, users):
+        """Replaces all user data (e.g. on restore), placing every user on its owner node.
+
+        Raises StorageNodeError while users are moving to a new node.
+        """
+        self._refresh_ring()
+        with self._reshard_lock:
+            self._check_not_moving()
+            by_owner = {name: {} for name in self._nodes}
+            for user_id, record in users.items():
+                by_owner[self._ring.node_for(str(user_id))][str(user_id)] = record
+            everything = range(LOCK_STRIPES)
+            self._acquire_stripes(everything)
+            try:
+                self._parallel(lambda item: self._nodes[item[0]].replace_all(item[1]), by_owner.items())
+            finally:
+                self._release_stripes(everything)
+
+
+def _resolve_spec(ring_file, spec):
+    """Ring files store directory specs relative to the ring file itself."""
+    if spec.startswith('tcp://'):
+        return spec
+    return os.path.join(os.path.dirname(os.path.abspath(ring_file)), spec)
+
+
+def _relative_spec(ring_file, spec):
+    if spec.startswith('tcp://'):
+        return spec
+    return os.path.relpath(os.path.abspath(spec), os.path.dirname(os.path.abspath(ring_file)))
+
+
+def load_ring(ring_file):
+    """Reads a ring file: {"nodes": {node_id: spec}, "moving_from": [node_id, ...] or null}."""
+    with open(ring_file, 'r') as f:
+        ring = json.load(f)
+    if not ring.get("nodes"):
+        raise ValueError(f"{ring_file} lists no storage nodes")
+    return ring
+
+
+def save_ring(ring_file, nodes, moving_from=None):
+    data_manager.save_data_file(ring_file, {"nodes": nodes, "moving_from": moving_from})
+
+
+def store_from_ring(ring_file):
+    """Builds the PartitionedStore a ring file describes, checking every node's id.
+
+    The store follows later changes to the ring file.
+    """
+    ring = load_ring(ring_file)
+    nodes = [node_from_spec(_resolve_spec(ring_file, spec), node_id=node_id)
+             for node_id, spec in ring["nodes"].items()]
+    return PartitionedStore(nodes, moving_from=ring.get("moving_from"), ring_file=ring_file)
+
+
+def create_ring(ring_file, specs):
+    """Writes a new ring file for the given node specs. Returns the nodes' ids."""
+    if os.path.exists(ring_file):
+        raise FileExistsError(f"{ring_file} already exists; use reshard to add nodes")
+    nodes = {node_from_spec(spec).name: _relative_spec(ring_file, spec) for spec in specs}
+    save_ring(ring_file, nodes)
+    return list(nodes)
+
+
+def _finish_reshard(ring_file, store, batch_size, grace):
+    moved = store.resume_reshard(batch_size)
+    save_ring(ring_file, load_ring(ring_file)["nodes"])
+    time.sleep(grace) # Until no process routes by the old ring, tombstones keep it from writing there
+    store.purge_moved()
+    return moved
+
+
+def reshard(ring_file, add_spec=None, batch_size=RESHARD_BATCH_SIZE, grace=RESHARD_GRACE):
+    """Adds a node to a ring file and moves the users it now owns. Returns the number moved.
+
+    The app and bot keep running: they re-read the ring file when it changes.
+    The ring file records the move first, and users start moving `grace`
+    seconds later, once requests routed by the old ring have finished. If
+    interrupted, processes still find every user, and running reshard again
+    (with or without add_spec) finishes the move. Only one reshard of a ring
+    file runs at a time.
+    """
+    with _file_lock(ring_file + '.lock', blocking=False):
+        store = store_from_ring(ring_file)
+        moved = 0
+        if load_ring(ring_file).get("moving_from"):
+            moved += _finish_reshard(ring_file, store, batch_size, grace)
+        else:
+            store.purge_moved() # Left behind if an earlier reshard was interrupted while purging
+        if add_spec is not None:
+            nodes = load_ring(ring_file)["nodes"]
+            node = node_from_spec(add_spec)
+            if node.name in nodes:
+                raise ValueError(f"Node {node.name} ({add_spec}) is already in {ring_file}")
+            previous = list(nodes)
+            nodes[node.name] = _relative_spec(ring_file, add_spec)
+            save_ring(ring_file, nodes, moving_from=previous)
+            time.sleep(grace)
+            moved += _finish_reshard(ring_file, store, batch_size, grace)
+        return moved
+
+
+class _NodeRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if request.get("op") not in NODE_OPERATIONS:
+                    raise ValueError(f"Unknown operation {request.get('op')!r}")
+                result = getattr(self.server.node, request["op"])(*request.get("args", []))
+                response = {"ok": True, "result": result}
+            except Exception as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}", "type": type(e).__name__}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class NodeServer(socketserver.ThreadingTCPServer):
+    """Serves a LocalNode to RemoteNode clients, one thread per connection."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, directory, host='127.0.0.1', port=0):
+        self.node = LocalNode(directory)
+        super().__init__((host, port), _NodeRequestHandler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run or reshard telehabit storage nodes.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help="Serve a directory as a storage node")
+    serve_parser.add_argument('--dir', required=True, help="Directory holding this node's user_data.json")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=0, help="Port to listen on (0: any free port)")
+    init_parser = commands.add_parser('init', help="Create a ring file listing the initial nodes")
+    init_parser.add_argument('--ring', required=True, help="Ring file to create")
+    init_parser.add_argument('nodes', nargs='+', help="Node specs (directories or tcp://host:port)")
+    reshard_parser = commands.add_parser('reshard', help="Add a node and move its users, while the app and bot keep running")
+    reshard_parser.add_argument('--ring', required=True, help="Ring file listing the current nodes")
+    reshard_parser.add_argument('--add', default=None, help="Spec of the node to add (default: only finish an interrupted reshard)")
+    reshard_parser.add_argument('--grace', type=float, default=RESHARD_GRACE,
+                                help="Seconds to wait for requests routed by the old ring (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        with NodeServer(args.dir, args.host, args.port) as server:
+            host, port = server.server_address[:2]
+            print(f"Serving node {server.node.name} from {server.node.directory} on tcp://{host}:{port}", flush=True)
+            server.serve_forever()
+    elif args.command == 'init':
+        node_ids = create_ring(args.ring, args.nodes)
+        print(f"Created {args.ring} with nodes {', '.join(node_ids)}.")
+    elif args.command == 'reshard':
+        moved = reshard(args.ring, args.add, grace=args.grace)
+        print(f"Moved {moved} users; {args.ring} is up to date.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Per-user limits on item counts, field lengths and stored size.
+
+Every limit can be overridden with an environment variable of the same name
+prefixed with TELEHABIT_, e.g. TELEHABIT_MAX_TASKS=500.
+
+Usage (report of the largest users):
+    python quotas.py [--limit 10]
+"""
+import argparse
+import json
+import os
+import threading
+
+
+def _limit(name, default):
+    return int(os.environ.get('TELEHABIT_' + name, default))
+
+
+MAX_TASKS = _limit('MAX_TASKS', 200)
+MAX_HABITS = _limit('MAX_HABITS', 100)
+MAX_NAME_LENGTH = _limit('MAX_NAME_LENGTH', 100)
+MAX_DESCRIPTION_LENGTH = _limit('MAX_DESCRIPTION_LENGTH', 1000)
+MAX_FREQUENCY_LENGTH = _limit('MAX_FREQUENCY_LENGTH', 20)
+MAX_USER_BYTES = _limit('MAX_USER_BYTES', 256 * 1024) # Serialized size of one user's data
+MAX_REQUEST_BYTES = _limit('MAX_REQUEST_BYTES', 16 * 1024) # Rejected before the body is parsed
+
+MAX_ITEMS = {"tasks": MAX_TASKS, "habits": MAX_HABITS}
+FIELD_LENGTHS = {
+    "name": MAX_NAME_LENGTH,
+    "description": MAX_DESCRIPTION_LENGTH,
+    "frequency": MAX_FREQUENCY_LENGTH,
+}
+
+
+def serialized_size(obj):
+    """Size in bytes of obj as compact JSON (a close, cheap proxy for its stored size)."""
+    return len(json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+
+
+class UsageTracker:
+    """Keeps the serialized size of each user's data, updated one user at a time.
+
+    data_manager.update_user records the user it just wrote, so sizes never
+    need to be recomputed across the whole dataset.
+    """
+
+    def __init__(self):
+        self._sizes = {}
+        self._seeded = False
+        self._lock = threading.Lock()
+
+    def record(self, user_id, user_data):
+        size = serialized_size(user_data)
+        with self._lock:
+            self._sizes[str(user_id)] = size
+        return size
+
+    def size(self, user_id, user_data):
+        """Returns the tracked size of a user, measuring user_data on first sight."""
+        with self._lock:
+            size = self._sizes.get(str(user_id))
+        if size is None:
+            size = self.record(user_id, user_data)
+        return size
+
+    def largest(self, limit=10):
+        """Returns [(user_id, bytes)] for the biggest users, largest first."""
+        import data_manager # Imported here: data_manager imports this module
+        if not self._seeded:
+            # One full pass to learn users that have not been written since startup.
+            for user_id, user_data in data_manager.all_users().items():
+                with self._lock:
+                    known = user_id in self._sizes
+                if not known:
+                    self.record(user_id, user_data)
+            self._seeded = True
+        with self._lock:
+            ranked = sorted(self._sizes.items(), key=lambda entry: entry[1], reverse=True)
+        return ranked[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._sizes.clear()
+            self._seeded = False
+
+
+usage = UsageTracker()
+
+
+def check_fields(**fields):
+    """Validates string fields against FIELD_LENGTHS. Returns an error message or None."""
+    for field, value in fields.items():
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            return f"Field '{field}' must be a string"
+        limit = FIELD_LENGTHS[field]
+        if len(value) > limit:
+            return f"Field '{field}' is too long (max {limit} characters)"
+    return None
+
+
+def check_item(user_id, user_data, collection, name, item):
+    """Checks that storing item under name in user_data[collection] stays within quota.
+
+    Covers both adding a new item and replacing an existing one. Returns an
+    error message or None.
+    """
+    items = user_data.get(collection) or {}
+    existing = items.get(name)
+    if existing is None and len(items) >= MAX_ITEMS[collection]:
+        return f"Too many {collection} (max {MAX_ITEMS[collection]})"
+
+    growth = serialized_size({name: item})
+    if existing is not None:
+        growth -= serialized_size({name: existing})
+    if growth > 0 and usage.size(user_id, user_data) + growth > MAX_USER_BYTES:
+        return f"User data size limit reached (max {MAX_USER_BYTES} bytes)"
+    return None
+
+
+def main(argv=None):
+    import data_manager
+    parser = argparse.ArgumentParser(description="Report the users with the most stored data.")
+    parser.add_argument('--limit', type=int, default=10, help="Number of users to show")
+    parser.add_argument('--data-file', default=None, help="User data file (default: %s)" % data_manager.DATA_FILE)
+    args = parser.parse_args(argv)
+    if args.data_file:
+        data_manager.DATA_FILE = args.data_file
+
+    for user_id, size in usage.largest(args.limit):
+        print(f"{user_id}\t{size} bytes")
+
+
+if __name__ == '__main__':
+    main()
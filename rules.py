@@ -0,0 +1,72 @@
+"""Gamification rules: the stat rewards and penalties for every action.
+
+A rule is a vector of stat deltas, e.g. {"experience": 10, "gold": 5}.
+Applying it adds each delta to the user's stat and clamps the result to
+STAT_LIMITS, so every entry point (bot and web app) behaves the same.
+"""
+
+# Stats a missing value is assumed to start from.
+STAT_DEFAULTS = {"health": 100, "experience": 0, "gold": 0}
+
+# (minimum, maximum) per stat; None means unbounded.
+STAT_LIMITS = {"health": (0, None), "experience": (0, None), "gold": (0, None)}
+
+TASK_COMPLETED = {"experience": 10, "gold": 5}
+TASK_UNCOMPLETED = {"experience": -10, "gold": -5} # Undoing a completion reverts its reward
+TASK_FAILED = {"health": -10}
+HABIT_COMPLETED = {"experience": 5, "gold": 2} # Less than tasks, habits are more frequent
+HABIT_FAILED = {"health": -5}
+
+
+# (default, minimum, maximum) per stat, resolved once so applying deltas
+# needs a single lookup per stat.
+STAT_BOUNDS = {stat: (STAT_DEFAULTS.get(stat, 0),) + STAT_LIMITS.get(stat, (None, None))
+               for stat in {**STAT_DEFAULTS, **STAT_LIMITS}}
+UNBOUNDED = (0, None, None)
+
+
+def _apply_to_records(records, deltas):
+    """Adds deltas to the stats of every record, clamped to STAT_LIMITS.
+
+    The single place rules are applied: one user for apply_deltas, many for
+    apply_bulk. Bounds are looked up once per stat, not once per record.
+    """
+    for stat, delta in deltas.items():
+        default, low, high = STAT_BOUNDS.get(stat, UNBOUNDED)
+        for user_data in records:
+            value = user_data.get(stat, default) + delta
+            if low is not None and value < low:
+                value = low
+            elif high is not None and value > high:
+                value = high
+            user_data[stat] = value
+
+
+def apply_deltas(user_data, deltas):
+    """Applies a vector of stat deltas to one user's data in place.
+
+    Returns user_data for convenience.
+    """
+    _apply_to_records((user_data,), deltas)
+    return user_data
+
+
+def apply_bulk(users, deltas, user_ids=None):
+    """Applies the same deltas to many users in place, e.g. for events or sweeps.
+
+    users is the mapping returned by data_manager.load_user_data(); user_ids
+    limits the change to those users (default: everyone). Unknown ids are
+    skipped. Returns the ids that were updated; the caller saves the data.
+    """
+    if user_ids is None:
+        user_ids = list(users)
+    updated = []
+    records = []
+    for user_id in user_ids:
+        user_data = users.get(str(user_id))
+        if user_data is None:
+            continue
+        records.append(user_data)
+        updated.append(str(user_id))
+    _apply_to_records(records, deltas)
+    return updated
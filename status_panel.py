@@ -0,0 +1,117 @@
+"""Inline-keyboard status panel for the bot, with a render cache.
+
+The panel is one message that is edited in place through callback queries.
+Every button carries the data version the panel was rendered from, so a tap
+that changes nothing can be answered without writing data or editing the
+message. Rendered panels are cached per user and data version.
+"""
+from collections import OrderedDict
+from functools import lru_cache
+import threading
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Make sure your Flask app is running on port 5000 locally
+WEBAPP_URL = 'http://127.0.0.1:5000/webapp?user_id={user_id}'
+
+CALLBACK_PREFIX = 'p'
+ACTION_REFRESH = 'r'
+ACTION_COMPLETE = 'c'
+MAX_CALLBACK_DATA = 64 # Telegram's limit, in bytes
+MAX_TASK_BUTTONS = 5
+MAX_BUTTON_LABEL = 30
+
+
+def data_version(user_data):
+    """Version of a user's data; data_manager.update_user bumps it on every write."""
+    return user_data.get('version', 0)
+
+
+def callback_data(action, version, task_name=None):
+    parts = [CALLBACK_PREFIX, action, str(version)]
+    if task_name is not None:
+        parts.append(task_name)
+    return ':'.join(parts)
+
+
+def parse_callback_data(data):
+    """Returns (action, version, task_name) for panel callback data, or None."""
+    parts = data.split(':', 3)
+    if len(parts) < 3 or parts[0] != CALLBACK_PREFIX or not parts[2].isdigit():
+        return None
+    return parts[1], int(parts[2]), parts[3] if len(parts) == 4 else None
+
+
+@lru_cache(maxsize=1024)
+def webapp_keyboard(user_id):
+    """The /webapp keyboard only depends on the user id, so it is built once per user."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Open Tasks & Habits", url=WEBAPP_URL.format(user_id=user_id))]
+    ])
+
+
+def build_panel(user_id, user_data):
+    """Renders the status text and keyboard for a user."""
+    version = data_version(user_data)
+    open_tasks = [name for name, task in (user_data.get('tasks') or {}).items()
+                  if not task.get('completed')]
+    text = (
+        f"Your Status:\n"
+        f"Health: {user_data['health']}\n"
+        f"Experience: {user_data['experience']}\n"
+        f"Gold: {user_data['gold']}\n"
+        f"Open tasks: {len(open_tasks)}"
+    )
+
+    rows = []
+    for name in open_tasks:
+        if len(rows) == MAX_TASK_BUTTONS:
+            break
+        data = callback_data(ACTION_COMPLETE, version, name)
+        if len(data.encode('utf-8')) > MAX_CALLBACK_DATA:
+            continue # Name too long to fit in a button; use /complete_task or the Web App
+        label = name if len(name) <= MAX_BUTTON_LABEL else name[:MAX_BUTTON_LABEL - 1] + '…'
+        rows.append([InlineKeyboardButton(f"✅ {label}", callback_data=data)])
+    rows.append([
+        InlineKeyboardButton("🔄 Refresh", callback_data=callback_data(ACTION_REFRESH, version)),
+        InlineKeyboardButton("Open Web App", url=WEBAPP_URL.format(user_id=user_id)),
+    ])
+    return text, InlineKeyboardMarkup(rows)
+
+
+class RenderCache:
+    """LRU cache of rendered panels, one entry per user, keyed on data version."""
+
+    def __init__(self, max_users=10000):
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, user_id, user_data):
+        """Returns (text, keyboard) for a user, rendering only if the version changed."""
+        user_id_str = str(user_id)
+        version = data_version(user_data)
+        with self._lock:
+            entry = self._entries.get(user_id_str)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(user_id_str)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        rendered = build_panel(user_id_str, user_data)
+        with self._lock:
+            self._entries[user_id_str] = (version, rendered)
+            self._entries.move_to_end(user_id_str)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+        return rendered
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+render_cache = RenderCache()
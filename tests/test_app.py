@@ -9,6 +9,8 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 from app import app
 import data_manager # Will be used for mocking its methods
+import events
+import quotas
 
 # In-memory store for our mock data manager
 MOCK_USER_DATA = {}
@@ -27,6 +29,7 @@ def mock_data_storage(monkeypatch):
     """Fixture to automatically mock data_manager.load_user_data and data_manager.save_user_data."""
     global MOCK_USER_DATA
     MOCK_USER_DATA = {} # Reset for each test
+    quotas.usage.clear() # Tracked sizes refer to the previous test's data
 
     monkeypatch.setattr(data_manager, 'load_user_data', mock_load_user_data)
     monkeypatch.setattr(data_manager, 'save_user_data', mock_save_user_data)
@@ -363,4 +366,131 @@ def test_delete_missing_habit(client):
     assert response.status_code == 404
     data = json.loads(response.data)
     assert data['error'] == "Habit not found or user data incomplete" # Message from app.py
-```
+
+# --- Test Live Update Stream ---
+def test_user_events_stream(client):
+    """Test GET /api/user/<user_id>/events pushes changes made by update_user."""
+    user_id = 'testuser_events'
+    MOCK_USER_DATA[user_id] = {"health": 100, "experience": 0, "gold": 0, "tasks": {}, "habits": {}}
+
+    response = client.get(f'/api/user/{user_id}/events')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    stream = response.iter_encoded()
+    assert next(stream).startswith(b'retry:')
+
+    # A change from any source (web app or bot) goes through update_user.
+    data_manager.update_user(user_id, {"gold": 5})
+    assert next(stream) == b'data: {"stats": {"gold": 5}}\n\n'
+
+    response.close()
+    assert not events.hub.has_subscribers(user_id)
+
+# --- Test Quotas ---
+def test_add_task_name_too_long(client):
+    """Test POST /api/user/<user_id>/tasks rejects over-long names."""
+    response = client.post('/api/user/testuser_long_name/tasks',
+                           data=json.dumps({"name": "x" * (quotas.MAX_NAME_LENGTH + 1)}),
+                           content_type='application/json')
+    assert response.status_code == 400
+    assert "too long" in json.loads(response.data)['error']
+    assert 'testuser_long_name' not in MOCK_USER_DATA
+
+def test_add_task_name_not_a_string(client):
+    """Test POST /api/user/<user_id>/tasks rejects non-string names."""
+    response = client.post('/api/user/testuser_bad_name/tasks',
+                           data=json.dumps({"name": {"nested": "object"}}),
+                           content_type='application/json')
+    assert response.status_code == 400
+
+def test_add_task_item_limit(client, monkeypatch):
+    """Test POST /api/user/<user_id>/tasks enforces the task count limit, but allows overwrites."""
+    monkeypatch.setitem(quotas.MAX_ITEMS, 'tasks', 1)
+    user_id = 'testuser_task_limit'
+    MOCK_USER_DATA[user_id] = {"health": 100, "experience": 0, "gold": 0,
+                               "tasks": {"only": {"description": "", "completed": False}}, "habits": {}}
+
+    response = client.post(f'/api/user/{user_id}/tasks', data=json.dumps({"name": "another"}),
+                           content_type='application/json')
+    assert response.status_code == 403
+    assert "another" not in MOCK_USER_DATA[user_id]['tasks']
+
+    response = client.post(f'/api/user/{user_id}/tasks', data=json.dumps({"name": "only", "description": "new"}),
+                           content_type='application/json')
+    assert response.status_code == 201
+
+def test_add_habit_user_size_limit(client, monkeypatch):
+    """Test POST /api/user/<user_id>/habits enforces the per-user size limit."""
+    user_id = 'testuser_size_limit'
+    MOCK_USER_DATA[user_id] = {"health": 100, "experience": 0, "gold": 0, "tasks": {}, "habits": {}}
+    monkeypatch.setattr(quotas, 'MAX_USER_BYTES', quotas.serialized_size(MOCK_USER_DATA[user_id]) + 200)
+
+    response = client.post(f'/api/user/{user_id}/habits', data=json.dumps({"name": "small"}),
+                           content_type='application/json')
+    assert response.status_code == 201
+    response = client.post(f'/api/user/{user_id}/habits',
+                           data=json.dumps({"name": "big", "description": "x" * 300}),
+                           content_type='application/json')
+    assert response.status_code == 403
+    assert "big" not in MOCK_USER_DATA[user_id]['habits']
+
+def test_edit_task_completed_must_be_bool(client):
+    """Test PUT /api/user/<user_id>/tasks/<task_id> rejects a non-bool 'completed' without storing or rewarding it."""
+    user_id = 'testuser_completed_type'
+    MOCK_USER_DATA[user_id] = {"health": 100, "experience": 0, "gold": 10,
+                               "tasks": {"task": {"description": "", "completed": False}}, "habits": {}}
+
+    response = client.put(f'/api/user/{user_id}/tasks/task', json={"completed": ["x" * 1000] * 10})
+    assert response.status_code == 400
+    assert MOCK_USER_DATA[user_id]["tasks"]["task"]["completed"] is False
+    assert MOCK_USER_DATA[user_id]["experience"] == 0
+
+def test_edit_task_counts_completed_against_size_limit(client, monkeypatch):
+    """Test the size quota on edits covers the merged task, not just the new description."""
+    user_id = 'testuser_edit_quota'
+    MOCK_USER_DATA[user_id] = {"health": 100, "experience": 0, "gold": 10,
+                               "tasks": {"task": {"description": "", "completed": False}}, "habits": {}}
+    monkeypatch.setattr(quotas, 'MAX_USER_BYTES', quotas.serialized_size(MOCK_USER_DATA[user_id]) + 10)
+
+    response = client.put(f'/api/user/{user_id}/tasks/task', json={"description": "x" * 100, "completed": True})
+    assert response.status_code == 403
+    assert MOCK_USER_DATA[user_id]["tasks"]["task"] == {"description": "", "completed": False}
+
+    response = client.put(f'/api/user/{user_id}/tasks/task', json={"completed": True})
+    assert response.status_code == 200
+
+def test_request_body_too_large(client, monkeypatch):
+    """Test oversized bodies are rejected with 413 before being parsed."""
+    monkeypatch.setitem(client.application.config, 'MAX_CONTENT_LENGTH', 64)
+    response = client.post('/api/user/testuser_big_body/tasks',
+                           data=json.dumps({"name": "task", "description": "x" * 100}),
+                           content_type='application/json')
+    assert response.status_code == 413
+    assert "error" in json.loads(response.data)
+
+def test_largest_users_report(client, monkeypatch):
+    """Test GET /api/admin/largest_users ranks users by stored size and requires the admin token."""
+    MOCK_USER_DATA['small'] = {"tasks": {}, "habits": {}}
+    MOCK_USER_DATA['large'] = {"tasks": {"t": {"description": "x" * 100, "completed": False}}, "habits": {}}
+
+    assert client.get('/api/admin/largest_users').status_code == 403
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    assert client.get('/api/admin/largest_users', headers={'X-Admin-Token': 'wrong'}).status_code == 403
+
+    response = client.get('/api/admin/largest_users?limit=1', headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 200
+    users = json.loads(response.data)['users']
+    assert [u['user_id'] for u in users] == ['large']
+
+def test_leaderboard(client, monkeypatch):
+    """Test GET /api/admin/leaderboard ranks users by a stat."""
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    MOCK_USER_DATA['a'] = {"experience": 5, "tasks": {}, "habits": {}}
+    MOCK_USER_DATA['b'] = {"experience": 50, "tasks": {}, "habits": {}}
+
+    response = client.get('/api/admin/leaderboard?stat=experience&limit=1', headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 200
+    assert json.loads(response.data)['users'] == [{"user_id": "b", "experience": 50}]
+
+    response = client.get('/api/admin/leaderboard?stat=version', headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 400
@@ -0,0 +1,117 @@
+import unittest
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import backup
+import data_manager
+from data_manager import save_user_data, load_user_data
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.original_data_file = data_manager.DATA_FILE
+        self.original_backup_dir = backup.BACKUP_DIR
+        data_manager.DATA_FILE = os.path.join(self.tmp_dir, 'user_data.json')
+        backup.BACKUP_DIR = os.path.join(self.tmp_dir, 'backups')
+        self.t0 = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        data_manager.DATA_FILE = self.original_data_file
+        backup.BACKUP_DIR = self.original_backup_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def test_incremental_backup_only_ships_changed_users(self):
+        save_user_data({"1": {"gold": 10}, "2": {"gold": 20}})
+        first = backup.create_backup(now=self.t0)
+        self.assertEqual(set(first["changed"]), {"1", "2"})
+
+        save_user_data({"1": {"gold": 11}, "2": {"gold": 20}})
+        second = backup.create_backup(now=self.t0 + timedelta(hours=1))
+        self.assertEqual(set(second["changed"]), {"1"})
+        self.assertEqual(second["parent"], first["backup_id"])
+
+    def test_unchanged_versions_are_not_rehashed(self):
+        save_user_data({str(i): {"gold": i, "version": 1} for i in range(100)})
+        backup.create_backup(now=self.t0)
+
+        users = load_user_data()
+        users["7"] = {"gold": 70, "version": 2}
+        save_user_data(users)
+        encoded = []
+        original_encode = backup._encode_user
+        backup._encode_user = lambda user: encoded.append(user) or original_encode(user)
+        try:
+            manifest = backup.create_backup(now=self.t0 + timedelta(hours=1))
+        finally:
+            backup._encode_user = original_encode
+        self.assertEqual(encoded, [{"gold": 70, "version": 2}])
+        self.assertEqual(list(manifest["changed"]), ["7"])
+        self.assertEqual(backup.state_at()["7"], {"gold": 70, "version": 2})
+        self.assertEqual(len(backup.state_at()), 100)
+
+    def test_no_backup_when_nothing_changed(self):
+        save_user_data({"1": {"gold": 10}})
+        backup.create_backup(now=self.t0)
+        self.assertIsNone(backup.create_backup(now=self.t0 + timedelta(hours=1)))
+        self.assertEqual(len(backup.list_backups()), 1)
+
+    def test_identical_records_share_a_chunk(self):
+        save_user_data({"1": {"gold": 10}, "2": {"gold": 10}})
+        manifest = backup.create_backup(now=self.t0)
+        self.assertEqual(manifest["changed"]["1"], manifest["changed"]["2"])
+
+    def test_restore_to_point_in_time(self):
+        save_user_data({"1": {"gold": 10}, "2": {"gold": 20}})
+        backup.create_backup(now=self.t0)
+        save_user_data({"1": {"gold": 11}})
+        backup.create_backup(now=self.t0 + timedelta(hours=2))
+
+        backup.restore(self.t0 + timedelta(hours=1))
+        self.assertEqual(load_user_data(), {"1": {"gold": 10, "version": 1}, "2": {"gold": 20, "version": 1}})
+
+        backup.restore()
+        self.assertEqual(load_user_data(), {"1": {"gold": 11, "version": 2}})
+
+    def test_restore_never_reuses_versions(self):
+        save_user_data({"1": {"gold": 10, "version": 3}})
+        backup.create_backup(now=self.t0)
+        save_user_data({"1": {"gold": 50, "version": 7}})
+
+        backup.restore()
+        self.assertEqual(load_user_data(), {"1": {"gold": 10, "version": 8}})
+
+    def test_restore_before_first_backup(self):
+        save_user_data({"1": {"gold": 10}})
+        backup.create_backup(now=self.t0)
+        with self.assertRaises(LookupError):
+            backup.restore(self.t0 - timedelta(days=1))
+
+    def test_partitioned_backups_keep_one_series_per_node(self):
+        from partitioning import LocalNode
+        nodes = [LocalNode(os.path.join(self.tmp_dir, name), window=0) for name in ('a', 'b')]
+        store = data_manager.configure_storage([node.directory for node in nodes])
+        try:
+            for i in range(20):
+                data_manager.update_user(str(i), {"gold": i})
+            results = backup.create_backups(now=self.t0)
+            self.assertEqual({node_id for node_id, _ in results}, {node.name for node in nodes})
+            for node in nodes:
+                self.assertEqual(backup.state_at(node_id=node.name), node.load_all())
+            self.assertFalse(os.path.exists(data_manager.DATA_FILE)) # The unused data file is not backed up
+
+            # Users move to a new node, then change; restoring puts everyone back on their current owner.
+            store.add_node(LocalNode(os.path.join(self.tmp_dir, 'c'), window=0))
+            for i in range(20):
+                data_manager.update_user(str(i), {"gold": 100})
+            backup.restore(self.t0 + timedelta(hours=1))
+
+            for i in range(20):
+                self.assertEqual(data_manager.get_user(str(i))["gold"], i)
+                self.assertEqual(sum(node.get_user(str(i)) is not None for node in store.nodes), 1)
+        finally:
+            data_manager.configure_storage()
+
+if __name__ == '__main__':
+    unittest.main()
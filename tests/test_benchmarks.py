@@ -0,0 +1,88 @@
+"""Micro-benchmarks for the gamification hot paths, with a regression gate.
+
+Each benchmark's best time is divided by the time of a fixed pure-Python
+calibration loop, so the stored baselines are comparable across machines.
+A benchmark fails when it is more than BENCHMARK_TOLERANCE times slower
+than its baseline in tests/benchmark_baselines.json.
+
+Re-record the baselines after an intentional change with:
+    BENCHMARK_UPDATE=1 python -m pytest tests/test_benchmarks.py
+"""
+import json
+import os
+import timeit
+
+import pytest
+
+import rules
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'benchmark_baselines.json')
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', '2.0'))
+UPDATE_BASELINES = os.environ.get('BENCHMARK_UPDATE') == '1'
+REPEAT = 5
+
+
+def _calibration_loop():
+    user = {"health": 100, "experience": 0, "gold": 0}
+    for i in range(1000):
+        user["gold"] = max(0, user["gold"] + i % 3 - 1)
+
+
+def _best_time(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=REPEAT)) / number
+
+
+@pytest.fixture(scope='module')
+def benchmark():
+    """Runs a benchmark and compares it with (or records) its baseline."""
+    unit = _best_time(_calibration_loop, 200)
+    try:
+        with open(BASELINE_FILE, 'r') as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+    measured = {}
+
+    def run(name, fn, number):
+        relative = _best_time(fn, number) / unit
+        measured[name] = round(relative, 6)
+        if UPDATE_BASELINES:
+            return relative
+        if name not in baselines:
+            pytest.fail(f"No baseline for benchmark '{name}'; run with BENCHMARK_UPDATE=1 to record it")
+        limit = baselines[name] * TOLERANCE
+        assert relative <= limit, (
+            f"Benchmark '{name}' regressed: {relative:.4f} calibration units, "
+            f"baseline {baselines[name]:.4f} (limit {limit:.4f})")
+        return relative
+
+    yield run
+
+    if UPDATE_BASELINES:
+        baselines.update(measured)
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baselines, f, indent=4, sort_keys=True)
+            f.write('\n')
+
+
+def _make_users(count):
+    return {str(i): {"health": 50 + i % 50, "experience": i % 7, "gold": i % 5, "tasks": {}, "habits": {}}
+            for i in range(count)}
+
+
+def test_bench_apply_deltas_reward(benchmark):
+    user = {"health": 100, "experience": 0, "gold": 10}
+    benchmark('apply_deltas_reward', lambda: rules.apply_deltas(user, rules.TASK_COMPLETED), 20000)
+
+def test_bench_apply_deltas_clamped_penalty(benchmark):
+    user = {"health": 0, "experience": 0, "gold": 0}
+    benchmark('apply_deltas_clamped_penalty', lambda: rules.apply_deltas(user, rules.TASK_UNCOMPLETED), 20000)
+
+def test_bench_apply_bulk_all_users(benchmark):
+    users = _make_users(10000)
+    benchmark('apply_bulk_10k_users', lambda: rules.apply_bulk(users, rules.HABIT_FAILED), 5)
+
+def test_bench_apply_bulk_selected_users(benchmark):
+    users = _make_users(10000)
+    user_ids = [str(i) for i in range(0, 10000, 10)]
+    benchmark('apply_bulk_1k_of_10k_users', lambda: rules.apply_bulk(users, rules.TASK_COMPLETED, user_ids), 20)
@@ -1,8 +1,11 @@
 import unittest
 import os
 import json
+import asyncio
+import threading
 import data_manager # To modify DATA_FILE
-from data_manager import load_user_data, save_user_data, get_user, update_user
+from data_manager import load_user_data, save_user_data, get_user, update_user, update_user_async, GroupCommitWriter, ExternalUpdateWatcher
+from events import hub
 
 class TestDataManager(unittest.TestCase):
     original_data_file = None
@@ -75,6 +78,13 @@ class TestDataManager(unittest.TestCase):
         self.assertEqual(user_data_after_update['tasks'], initial_user_state['tasks'])
 
 
+    def test_update_user_bumps_version(self):
+        user_id = "versioned_user"
+        first = update_user(user_id, {'gold': 1})
+        second = update_user(user_id, {'gold': 2})
+        self.assertEqual(second['version'], first['version'] + 1)
+        self.assertEqual(load_user_data()[user_id]['version'], second['version'])
+
     def test_load_user_data_file_not_found(self):
         # setUp ensures the file is deleted
         loaded_data = load_user_data()
@@ -86,5 +96,137 @@ class TestDataManager(unittest.TestCase):
         loaded_data = load_user_data()
         self.assertEqual(loaded_data, {})
 
+    def test_update_user_async(self):
+        stored = asyncio.run(update_user_async("async_user", {'gold': 42}))
+        self.assertEqual(stored['gold'], 42)
+        self.assertEqual(load_user_data()["async_user"]['gold'], 42)
+
+    def test_group_commit_coalesces_concurrent_updates(self):
+        writer = GroupCommitWriter(window=0.05, max_batch=100)
+        barrier = threading.Barrier(20)
+        results = {}
+
+        def worker(i):
+            barrier.wait()
+            results[i] = writer.submit(f"user_{i}", {'gold': i}).result()[1]
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stored = load_user_data()
+        for i in range(20):
+            self.assertEqual(results[i]['gold'], i)
+            self.assertEqual(stored[f"user_{i}"]['gold'], i)
+        self.assertLess(writer.batches, 20)
+
+    def test_group_commit_applies_same_user_updates_in_order(self):
+        writer = GroupCommitWriter(window=0.05)
+        first = writer.submit("same_user", {'gold': 1, 'health': 50})
+        second = writer.submit("same_user", {'gold': 2})
+        _, first_stored = first.result()
+        previous, second_stored = second.result()
+        self.assertEqual(first_stored['gold'], 1)
+        self.assertEqual(previous['gold'], 1)
+        self.assertEqual(second_stored['gold'], 2)
+        self.assertEqual(second_stored['health'], 50)
+        self.assertEqual(second_stored['version'], first_stored['version'] + 1)
+
+    def test_group_commit_reports_write_errors(self):
+        writer = GroupCommitWriter(window=0)
+        original_save = data_manager.save_user_data
+        def failing_save(data):
+            raise OSError("disk full")
+        data_manager.save_user_data = failing_save
+        try:
+            with self.assertRaises(OSError):
+                writer.submit("unlucky_user", {'gold': 1}).result()
+        finally:
+            data_manager.save_user_data = original_save
+        # The writer keeps serving later updates.
+        self.assertEqual(writer.submit("unlucky_user", {'gold': 2}).result()[1]['gold'], 2)
+
+    def test_group_commit_failed_op_leaves_no_trace(self):
+        writer = GroupCommitWriter(window=0.05)
+        def half_done(users):
+            users["victim"] = {"gold": 999}
+            raise ValueError("gave up halfway")
+        failing = writer.submit_op(half_done)
+        ok = writer.submit("bystander", {'gold': 7})
+
+        with self.assertRaises(ValueError):
+            failing.result()
+        self.assertEqual(ok.result()[1]['gold'], 7)
+        stored = load_user_data()
+        self.assertNotIn("victim", stored)
+        self.assertEqual(stored["bystander"]['gold'], 7)
+
+    def test_apply_bulk_bumps_versions_and_notifies(self):
+        save_user_data({"1": {"gold": 10, "version": 2}, "2": {"gold": 20}})
+        subscription = hub.subscribe("1")
+        try:
+            self.assertEqual(sorted(data_manager.apply_bulk({"gold": 5})), ["1", "2"])
+            self.assertEqual(subscription.get_nowait(), {"stats": {"gold": 15}})
+        finally:
+            hub.unsubscribe("1", subscription)
+        stored = load_user_data()
+        self.assertEqual(stored["1"], {"gold": 15, "version": 3})
+        self.assertEqual(stored["2"], {"gold": 25, "version": 1})
+        self.assertEqual(data_manager.usage.size("1", {}), len(json.dumps(stored["1"], separators=(',', ':'))))
+
+    def test_external_updates_reach_subscribers(self):
+        user_id = "watched_user"
+        save_user_data({user_id: {"health": 100, "experience": 0, "gold": 10, "tasks": {}, "habits": {}, "version": 1}})
+        watcher = ExternalUpdateWatcher()
+        subscription = hub.subscribe(user_id)
+        try:
+            watcher.poll() # First sight only records a baseline
+            self.assertTrue(subscription.empty())
+
+            # Another process (e.g. the bot) saves a change to the shared data file.
+            save_user_data({user_id: {"health": 100, "experience": 0, "gold": 15, "tasks": {}, "habits": {}, "version": 2}})
+            watcher.poll()
+            self.assertEqual(subscription.get_nowait(), {"stats": {"gold": 15}})
+
+            # A change already published in this process is not published again.
+            watcher.observe(user_id, {"health": 100, "experience": 0, "gold": 20, "tasks": {}, "habits": {}, "version": 3})
+            self.assertEqual(subscription.get_nowait(), {"stats": {"gold": 20}})
+            save_user_data({user_id: {"health": 100, "experience": 0, "gold": 20, "tasks": {}, "habits": {}, "version": 3}})
+            watcher.poll()
+            self.assertTrue(subscription.empty())
+        finally:
+            hub.unsubscribe(user_id, subscription)
+
+    def test_external_updates_are_published_in_version_order(self):
+        user_id = "raced_user"
+        watcher = ExternalUpdateWatcher()
+        subscription = hub.subscribe(user_id)
+        base = {"health": 100, "experience": 0, "gold": 10, "tasks": {}, "habits": {}}
+        published_under_lock = []
+        original_publish = hub.publish
+        def publish(*args):
+            published_under_lock.append(watcher._lock.locked())
+            original_publish(*args)
+        hub.publish = publish
+        try:
+            watcher.observe(user_id, dict(base, version=1))
+            threads = [threading.Thread(target=watcher.observe, args=(user_id, dict(base, gold=10 + v, version=v)))
+                       for v in range(2, 40)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            golds = []
+            while not subscription.empty():
+                golds.append(subscription.get_nowait()["stats"]["gold"])
+            self.assertEqual(golds, sorted(golds))
+            self.assertTrue(all(published_under_lock))
+        finally:
+            hub.publish = original_publish
+            hub.unsubscribe(user_id, subscription)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,55 @@
+import queue
+
+from events import EventHub, diff_user
+
+
+def test_publish_reaches_only_that_users_subscribers():
+    hub = EventHub()
+    mine = hub.subscribe("1")
+    other = hub.subscribe("2")
+
+    hub.publish(1, {"stats": {"gold": 15}})
+
+    assert mine.get_nowait() == {"stats": {"gold": 15}}
+    assert other.empty()
+
+def test_unsubscribe_stops_delivery():
+    hub = EventHub()
+    q = hub.subscribe("1")
+    hub.unsubscribe("1", q)
+
+    assert not hub.has_subscribers("1")
+    hub.publish("1", {"stats": {"gold": 15}})
+    assert q.empty()
+
+def test_full_queue_drops_oldest_event():
+    hub = EventHub(max_queue_size=2)
+    q = hub.subscribe("1")
+    for gold in (1, 2, 3):
+        hub.publish("1", {"stats": {"gold": gold}})
+
+    assert q.get_nowait() == {"stats": {"gold": 2}}
+    assert q.get_nowait() == {"stats": {"gold": 3}}
+    try:
+        q.get_nowait()
+        assert False, "Expected the queue to be drained"
+    except queue.Empty:
+        pass
+
+def test_diff_user_reports_only_changes():
+    old = {"health": 100, "experience": 0, "gold": 10,
+           "tasks": {"a": {"description": "", "completed": False}, "b": {"description": "", "completed": False}},
+           "habits": {"h": {"streak": 1}}}
+    new = {"health": 100, "experience": 10, "gold": 15,
+           "tasks": {"a": {"description": "", "completed": True}},
+           "habits": {"h": {"streak": 1}}}
+
+    assert diff_user(old, new) == {
+        "stats": {"experience": 10, "gold": 15},
+        "tasks": {"a": {"description": "", "completed": True}},
+        "removed_tasks": ["b"],
+    }
+
+def test_diff_user_no_changes():
+    user = {"health": 100, "experience": 0, "gold": 10, "tasks": {}, "habits": {}}
+    assert diff_user(user, dict(user)) == {}
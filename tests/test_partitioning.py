@@ -0,0 +1,257 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import data_manager
+import rules
+from partitioning import (HashRing, LocalNode, PartitionedStore, RemoteNode, StorageNodeError, create_ring, load_ring,
+                          node_from_spec, reshard, store_from_ring)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+@pytest.fixture
+def local_nodes(tmp_path):
+    return [LocalNode(str(tmp_path / name), window=0) for name in ('a', 'b', 'c')]
+
+
+@pytest.fixture
+def node_processes(tmp_path):
+    """Starts storage node worker processes and returns their specs."""
+    processes = []
+
+    def start(name):
+        process = subprocess.Popen(
+            [sys.executable, 'partitioning.py', 'serve', '--dir', str(tmp_path / name), '--port', '0'],
+            cwd=PROJECT_ROOT, stdout=subprocess.PIPE, text=True)
+        processes.append(process)
+        line = process.stdout.readline() # "Serving <dir> on tcp://host:port"
+        return line.split()[-1]
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+def test_hash_ring_moves_few_keys_and_only_to_the_new_node():
+    keys = [str(i) for i in range(2000)]
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b', 'c', 'd'])
+
+    moved = [key for key in keys if before.node_for(key) != after.node_for(key)]
+    assert all(after.node_for(key) == 'd' for key in moved)
+    assert 0.1 < len(moved) / len(keys) < 0.4
+    assert HashRing(['c', 'b', 'a']).node_for('42') == before.node_for('42')
+
+
+def test_node_ids_do_not_depend_on_how_the_node_is_addressed(tmp_path, monkeypatch):
+    node = LocalNode(str(tmp_path / 'a'))
+    os.symlink(tmp_path / 'a', tmp_path / 'link')
+    monkeypatch.chdir(tmp_path)
+
+    assert LocalNode('a').name == LocalNode(str(tmp_path / 'link')).name == node.name
+    assert LocalNode(str(tmp_path / 'b')).name != node.name
+    assert node_from_spec(str(tmp_path / 'a'), node_id=node.name).name == node.name
+    with pytest.raises(StorageNodeError):
+        node_from_spec(str(tmp_path / 'a'), node_id='someone-else')
+    with pytest.raises(StorageNodeError):
+        node_from_spec(str(tmp_path / 'moved'), node_id=node.name) # Not silently a new, empty node
+
+
+def test_users_are_stored_on_exactly_one_node(local_nodes):
+    store = PartitionedStore(local_nodes)
+    for i in range(50):
+        store.update_user(str(i), {"gold": i})
+
+    for i in range(50):
+        holders = [node for node in local_nodes if node.get_user(str(i)) is not None]
+        assert holders == [store.node_for(str(i))]
+        assert store.get_user(str(i))["gold"] == i
+    assert store.get_user("missing") is None
+
+
+def test_add_node_moves_users_and_keeps_their_data(local_nodes):
+    store = PartitionedStore(local_nodes[:2])
+    for i in range(200):
+        store.update_user(str(i), {"gold": i})
+
+    moved = store.add_node(local_nodes[2])
+
+    assert moved == len(local_nodes[2].user_ids()) > 0
+    for i in range(200):
+        assert store.get_user(str(i))["gold"] == i
+        assert sum(node.get_user(str(i)) is not None for node in local_nodes) == 1
+
+
+def test_add_node_online_keeps_concurrent_writes(local_nodes):
+    store = PartitionedStore(local_nodes[:2])
+    user_ids = [str(i) for i in range(60)]
+    for user_id in user_ids:
+        store.update_user(user_id, {"gold": 0})
+
+    def writer(ids):
+        for value in range(1, 6):
+            for user_id in ids:
+                store.update_user(user_id, {"gold": value})
+
+    threads = [threading.Thread(target=writer, args=(user_ids[i::3],)) for i in range(3)]
+    for t in threads:
+        t.start()
+    store.add_node(local_nodes[2], batch_size=5)
+    for t in threads:
+        t.join()
+
+    for user_id in user_ids:
+        assert store.get_user(user_id)["gold"] == 5
+        assert sum(node.get_user(user_id) is not None for node in local_nodes) == 1
+
+
+def test_parallel_scans_cover_all_partitions(local_nodes):
+    store = PartitionedStore(local_nodes)
+    for i in range(30):
+        store.update_user(str(i), {"experience": i, "health": 100})
+
+    assert store.leaderboard('experience', 3) == [("29", 29), ("28", 28), ("27", 27)]
+    assert len(store.all_users()) == 30
+
+    updated = store.apply_bulk(rules.TASK_FAILED)
+    assert sorted(updated, key=int) == [str(i) for i in range(30)]
+    assert list(store.apply_bulk({"gold": 1}, user_ids=["3", "missing"])) == ["3"]
+    assert all(user["health"] == 90 for user in store.all_users().values())
+
+
+def test_remote_node_processes(tmp_path, node_processes):
+    store = PartitionedStore([node_from_spec(node_processes('p1')), LocalNode(str(tmp_path / 'local'))])
+    for i in range(40):
+        store.update_user(str(i), {"gold": i})
+
+    remote = node_from_spec(node_processes('p2'))
+    assert isinstance(remote, RemoteNode)
+    assert store.add_node(remote) > 0
+
+    for i in range(40):
+        assert store.get_user(str(i))["gold"] == i
+    assert store.leaderboard('gold', 1) == [("39", 39)]
+
+
+def test_remote_node_id_does_not_depend_on_the_address(node_processes):
+    address = node_processes('p')
+    port = address.rpartition(':')[2]
+    node = node_from_spec(address)
+
+    assert node_from_spec(f"tcp://localhost:{port}").name == node.name
+    assert node_from_spec(address, node_id=node.name).user_ids() == []
+    with pytest.raises(StorageNodeError):
+        node_from_spec(address, node_id='someone-else').user_ids()
+
+
+def test_remote_node_reports_errors(node_processes):
+    remote = node_from_spec(node_processes('p'))
+    with pytest.raises(StorageNodeError):
+        remote.put_users_if_absent("not a dict")
+    assert remote.user_ids() == [] # Connection is still usable
+
+
+def test_reshard_persists_the_ring_for_other_processes(tmp_path):
+    ring_file = str(tmp_path / 'ring.json')
+    create_ring(ring_file, [str(tmp_path / 'n1')])
+    store = store_from_ring(ring_file)
+    for i in range(20):
+        store.update_user(str(i), {"gold": i})
+
+    assert reshard(ring_file, str(tmp_path / 'n2'), grace=0) > 0
+
+    # A process started afterwards (or the bot) sees every user.
+    restarted = store_from_ring(ring_file)
+    assert len(restarted.nodes) == 2
+    for i in range(20):
+        assert restarted.get_user(str(i))["gold"] == i
+    with pytest.raises(ValueError):
+        reshard(ring_file, str(tmp_path / 'n2'), grace=0)
+
+
+def test_interrupted_reshard_is_recorded_and_resumed(tmp_path, monkeypatch):
+    ring_file = str(tmp_path / 'ring.json')
+    create_ring(ring_file, [str(tmp_path / 'a'), str(tmp_path / 'b')])
+    store = store_from_ring(ring_file)
+    for i in range(50):
+        store.update_user(str(i), {"gold": i})
+
+    def crash(self, source, batch_size):
+        raise OSError("disk full")
+    with monkeypatch.context() as m:
+        m.setattr(PartitionedStore, '_move_misplaced', crash)
+        with pytest.raises(OSError):
+            reshard(ring_file, str(tmp_path / 'c'), grace=0)
+    assert load_ring(ring_file)["moving_from"] is not None
+
+    # Users not moved yet are still found, then reshard finishes the move.
+    assert all(store_from_ring(ring_file).get_user(str(i))["gold"] == i for i in range(50))
+    reshard(ring_file, grace=0)
+    assert load_ring(ring_file)["moving_from"] is None
+    restarted = store_from_ring(ring_file)
+    for i in range(50):
+        assert restarted.node_for(str(i)).get_user(str(i))["gold"] == i
+
+
+WRITER = """
+import os, sys
+from partitioning import store_from_ring
+
+ring_file, stop_file = sys.argv[1:]
+store = store_from_ring(ring_file)
+value = 0
+while not os.path.exists(stop_file):
+    value += 1
+    for i in range(40):
+        store.update_user(str(i), {"gold": value})
+    if value == 1:
+        print("writing", flush=True)
+print(value, flush=True)
+"""
+
+
+def test_reshard_while_another_process_keeps_writing(tmp_path):
+    ring_file = str(tmp_path / 'ring.json')
+    stop_file = str(tmp_path / 'stop')
+    create_ring(ring_file, [str(tmp_path / 'a'), str(tmp_path / 'b')])
+    writer = subprocess.Popen([sys.executable, '-c', WRITER, ring_file, stop_file],
+                              cwd=PROJECT_ROOT, stdout=subprocess.PIPE, text=True)
+    try:
+        assert writer.stdout.readline().strip() == "writing"
+        store = store_from_ring(ring_file)
+        before = store.get_user("0")["gold"]
+
+        assert reshard(ring_file, str(tmp_path / 'c'), batch_size=5, grace=0.2) > 0
+        assert store.get_user("0")["gold"] > before # Kept writing during the reshard
+    finally:
+        open(stop_file, 'w').close()
+        last_value = int(writer.stdout.readline())
+        writer.wait()
+
+    assert len(store.nodes) == 3 # Picked up the new node from the ring file
+    for i in range(40):
+        assert store.get_user(str(i))["gold"] == last_value
+        assert sum(node.get_user(str(i)) is not None for node in store.nodes) == 1
+    assert sum(len(data_manager.load_data_file(node.path)) for node in store.nodes) == 40 # No tombstones left
+
+
+def test_data_manager_routes_through_partitions(tmp_path):
+    original_data_file = data_manager.DATA_FILE
+    data_manager.DATA_FILE = str(tmp_path / 'unused.json')
+    try:
+        store = data_manager.configure_storage([str(tmp_path / 'a'), str(tmp_path / 'b')])
+        data_manager.update_user("7", {"gold": 70})
+
+        assert data_manager.get_user("7")["gold"] == 70
+        assert store.node_for("7").get_user("7")["gold"] == 70
+        assert data_manager.get_user("new")["health"] == 100
+        assert data_manager.leaderboard('gold', 1) == [("7", 70)]
+        assert not os.path.exists(data_manager.DATA_FILE)
+    finally:
+        data_manager.configure_storage([])
+        data_manager.DATA_FILE = original_data_file
@@ -0,0 +1,39 @@
+import rules
+
+def test_apply_deltas_rewards():
+    user = {"health": 100, "experience": 0, "gold": 10}
+    rules.apply_deltas(user, rules.TASK_COMPLETED)
+    assert user == {"health": 100, "experience": 10, "gold": 15}
+
+def test_apply_deltas_clamps_at_zero():
+    user = {"health": 3, "experience": 4, "gold": 1}
+    rules.apply_deltas(user, rules.TASK_FAILED)
+    rules.apply_deltas(user, rules.TASK_UNCOMPLETED)
+    assert user == {"health": 0, "experience": 0, "gold": 0}
+
+def test_apply_deltas_missing_stats_use_defaults():
+    user = {}
+    rules.apply_deltas(user, rules.HABIT_FAILED)
+    rules.apply_deltas(user, rules.HABIT_COMPLETED)
+    assert user == {"health": 95, "experience": 5, "gold": 2}
+
+def test_apply_bulk_all_users():
+    users = {"1": {"health": 100, "experience": 0, "gold": 0}, "2": {"health": 5}}
+    updated = rules.apply_bulk(users, rules.TASK_FAILED)
+    assert updated == ["1", "2"]
+    assert users["1"]["health"] == 90
+    assert users["2"]["health"] == 0
+
+def test_apply_bulk_selected_users_skips_unknown():
+    users = {"1": {"gold": 0}, "2": {"gold": 0}}
+    updated = rules.apply_bulk(users, {"gold": 3}, user_ids=[2, "missing"])
+    assert updated == ["2"]
+    assert users == {"1": {"gold": 0}, "2": {"gold": 3}}
+
+def test_apply_bulk_matches_apply_deltas():
+    users = {"1": {"health": 7, "experience": 3, "gold": 2}}
+    single = dict(users["1"])
+    for deltas in (rules.TASK_FAILED, rules.TASK_UNCOMPLETED, rules.HABIT_COMPLETED):
+        rules.apply_bulk(users, deltas)
+        rules.apply_deltas(single, deltas)
+    assert users["1"] == single
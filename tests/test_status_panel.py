@@ -0,0 +1,128 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import data_manager
+import main
+import rules
+import status_panel
+
+MOCK_USER_DATA = {}
+
+@pytest.fixture(autouse=True)
+def mock_data_storage(monkeypatch):
+    """Keeps user data in memory and counts saves."""
+    global MOCK_USER_DATA
+    MOCK_USER_DATA = {}
+    saves = []
+
+    def save(data):
+        global MOCK_USER_DATA
+        saves.append(data)
+        MOCK_USER_DATA = json.loads(json.dumps(data))
+
+    monkeypatch.setattr(data_manager, 'load_user_data', lambda: json.loads(json.dumps(MOCK_USER_DATA)))
+    monkeypatch.setattr(data_manager, 'save_user_data', save)
+    status_panel.render_cache.clear()
+    return saves
+
+def make_user(version=3, tasks=None):
+    return {"health": 100, "experience": 0, "gold": 10, "tasks": tasks or {}, "habits": {}, "version": version}
+
+def make_callback_update(user_id, data):
+    update = MagicMock()
+    update.callback_query.from_user.id = user_id
+    update.callback_query.data = data
+    update.callback_query.answer = AsyncMock()
+    update.callback_query.edit_message_text = AsyncMock()
+    return update
+
+def test_callback_data_round_trip():
+    data = status_panel.callback_data(status_panel.ACTION_COMPLETE, 7, "read: chapter 1")
+    assert status_panel.parse_callback_data(data) == ('c', 7, "read: chapter 1")
+    assert status_panel.parse_callback_data(status_panel.callback_data('r', 2)) == ('r', 2, None)
+    assert status_panel.parse_callback_data("something else") is None
+
+def test_build_panel_skips_names_too_long_for_callback_data():
+    user = make_user(tasks={"short": {"completed": False}, "x" * 80: {"completed": False},
+                            "done": {"completed": True}})
+    text, keyboard = status_panel.build_panel("1", user)
+    assert "Open tasks: 2" in text
+    all_data = [button.callback_data for row in keyboard.inline_keyboard for button in row if button.callback_data]
+    assert all_data == ["p:c:3:short", "p:r:3"]
+
+def test_render_cache_keyed_on_version():
+    cache = status_panel.RenderCache()
+    user = make_user(version=1)
+    first = cache.render("1", user)
+    assert cache.render("1", user) is first
+    assert cache.hits == 1
+
+    user["gold"] = 99
+    user["version"] = 2
+    text, _ = cache.render("1", user)
+    assert "Gold: 99" in text
+    assert cache.misses == 2
+
+def test_render_cache_evicts_least_recently_used():
+    cache = status_panel.RenderCache(max_users=1)
+    cache.render("1", make_user())
+    cache.render("2", make_user())
+    cache.render("1", make_user())
+    assert cache.misses == 3
+
+def test_refresh_with_unchanged_version_skips_edit(mock_data_storage):
+    MOCK_USER_DATA["1"] = make_user(version=3)
+    update = make_callback_update(1, "p:r:3")
+
+    asyncio.run(main.status_panel_callback(update, MagicMock()))
+
+    update.callback_query.answer.assert_awaited_once()
+    update.callback_query.edit_message_text.assert_not_awaited()
+    assert mock_data_storage == []
+
+def test_refresh_after_outside_change_edits_panel(mock_data_storage):
+    MOCK_USER_DATA["1"] = make_user(version=4)
+    update = make_callback_update(1, "p:r:3")
+
+    asyncio.run(main.status_panel_callback(update, MagicMock()))
+
+    update.callback_query.edit_message_text.assert_awaited_once()
+    assert mock_data_storage == []
+
+def test_bulk_apply_invalidates_panel(mock_data_storage):
+    MOCK_USER_DATA["1"] = make_user(version=3)
+    assert "Gold: 10" in status_panel.render_cache.render("1", data_manager.get_user("1"))[0]
+
+    assert data_manager.apply_bulk(rules.TASK_COMPLETED) == ["1"]
+
+    user_data = data_manager.get_user("1")
+    assert user_data["version"] == 4
+    assert "Gold: 15" in status_panel.render_cache.render("1", user_data)[0]
+    update = make_callback_update(1, "p:r:3")
+    asyncio.run(main.status_panel_callback(update, MagicMock()))
+    update.callback_query.edit_message_text.assert_awaited_once()
+
+def test_complete_button_rewards_and_edits_panel(mock_data_storage):
+    MOCK_USER_DATA["1"] = make_user(version=3, tasks={"walk": {"description": "", "completed": False}})
+    update = make_callback_update(1, "p:c:3:walk")
+
+    asyncio.run(main.status_panel_callback(update, MagicMock()))
+
+    stored = MOCK_USER_DATA["1"]
+    assert stored["tasks"]["walk"]["completed"] is True
+    assert stored["experience"] == 10 and stored["gold"] == 15
+    assert stored["version"] == 4
+    text = update.callback_query.edit_message_text.await_args.kwargs["text"]
+    assert "Experience: 10" in text
+
+def test_complete_button_on_done_task_changes_nothing(mock_data_storage):
+    MOCK_USER_DATA["1"] = make_user(version=3, tasks={"walk": {"description": "", "completed": True}})
+    update = make_callback_update(1, "p:c:3:walk")
+
+    asyncio.run(main.status_panel_callback(update, MagicMock()))
+
+    assert mock_data_storage == []
+    update.callback_query.edit_message_text.assert_not_awaited()
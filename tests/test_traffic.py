@@ -0,0 +1,141 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import data_manager
+import traffic
+from app import app
+from traffic import BotCapture, CaptureMiddleware, CaptureWriter, Sanitizer
+
+KEY = 'test-key'
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    original = data_manager.DATA_FILE
+    data_manager.DATA_FILE = str(tmp_path / 'user_data.json')
+    yield data_manager.DATA_FILE
+    data_manager.DATA_FILE = original
+
+
+@pytest.fixture
+def capture(tmp_path, monkeypatch):
+    """Captures the app's API traffic to a file; returns its path."""
+    path = str(tmp_path / 'capture.jsonl')
+    writer = CaptureWriter(path)
+    monkeypatch.setattr(app, 'wsgi_app', CaptureMiddleware(app.wsgi_app, writer, Sanitizer(KEY)))
+    yield path
+    writer.close()
+
+
+def test_sanitizer_is_consistent_and_masks_text():
+    sanitizer = Sanitizer(KEY)
+    user, task = sanitizer.pseudonym('42'), sanitizer.pseudonym('Buy milk')
+
+    assert sanitizer.path('/api/user/42/tasks/Buy milk/fail') == f'/api/user/{user}/tasks/{task}/fail'
+    assert sanitizer.body({"name": "Buy milk", "description": "secret", "frequency": "daily", "x": {"a": 1}}) == \
+        {"name": task, "description": "xxxxxx", "frequency": "daily"}
+    assert sanitizer.query('user_id=42&limit=5') == f'user_id={user}&limit=5'
+    assert sanitizer.callback_data('p:c:3:Buy milk') == f'p:c:3:{task}'
+
+    snapshot = sanitizer.user_data({"42": {"tasks": {"Buy milk": {"description": "secret"}}, "habits": {}}})
+    assert snapshot == {user: {"tasks": {task: {"description": "xxxxxx"}}, "habits": {}}}
+    assert Sanitizer('other-key').pseudonym('42') != user
+
+
+def test_capture_middleware_records_sanitized_requests(data_file, capture):
+    client = app.test_client()
+    client.post('/api/user/42/tasks', json={"name": "Buy milk", "description": "2 litres"})
+    client.get('/api/admin/largest_users')
+
+    with open(capture) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 1 # Admin requests are not captured
+    record = records[0]
+    assert record["method"] == 'POST' and record["status"] == 201
+    assert record["body"]["description"] == 'xxxxxxxx'
+    assert '42' not in record["path"] and 'Buy milk' not in json.dumps(record)
+    # The app still saw the real body.
+    assert data_manager.load_user_data()["42"]["tasks"]["Buy milk"]["description"] == '2 litres'
+
+
+def test_bot_capture_records_sanitized_commands(tmp_path):
+    path = str(tmp_path / 'capture.jsonl')
+    writer = CaptureWriter(path)
+    calls = []
+
+    async def handler(update, context):
+        calls.append(context.args)
+
+    wrapped = BotCapture(writer, Sanitizer(KEY)).wrap('complete_task', handler)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=42))
+    asyncio.run(wrapped(update, SimpleNamespace(args=['Buy', 'milk'])))
+    writer.close()
+
+    assert calls == [['Buy', 'milk']]
+    with open(path) as f:
+        record = json.loads(f.readline())
+    assert record["command"] == 'complete_task'
+    assert record["user_id"] == Sanitizer(KEY).pseudonym(42)
+    assert record["args"] == [Sanitizer(KEY).pseudonym('Buy milk')]
+
+
+def test_replay_reproduces_final_state(data_file, capture):
+    data_manager.save_user_data({"42": {"health": 100, "experience": 0, "gold": 10, "tasks": {}, "habits": {}}})
+    snapshot = Sanitizer(KEY).user_data(data_manager.load_user_data())
+
+    client = app.test_client()
+    client.post('/api/user/42/tasks', json={"name": "Buy milk"})
+    client.put('/api/user/42/tasks/Buy milk', json={"completed": True})
+    client.post('/api/user/7/habits', json={"name": "Read", "description": "20 pages"})
+    client.post('/api/user/7/habits/Read/complete')
+    client.post('/api/user/7/habits/Read/fail')
+    expected = Sanitizer(KEY).user_data(data_manager.load_user_data())
+
+    records = traffic.load_capture(capture)
+    latencies, final_state, errors = traffic.replay(records, snapshot)
+
+    assert errors == []
+    assert sum(map(len, latencies.values())) == 5
+    assert 'POST /api/user/<user>/habits/<name>/complete' in latencies
+    assert traffic.diff_states(expected, final_state) == []
+    # Replaying again from the same snapshot gives the same result.
+    assert traffic.diff_states(final_state, traffic.replay(records, snapshot)[1]) == []
+    # Capture is still enabled, but the replays were not recorded.
+    assert traffic.load_capture(capture) == records
+    assert isinstance(app.wsgi_app, CaptureMiddleware)
+
+
+def test_replay_bot_commands_and_reports_differences(data_file):
+    sanitizer = Sanitizer(KEY)
+    user = sanitizer.pseudonym(42)
+    snapshot = {user: {"health": 100, "experience": 0, "gold": 10, "tasks": {}, "habits": {}}}
+    records = [
+        {"ts": 1.0, "source": "bot", "command": "complete_task", "user_id": user, "args": ["pTask"]},
+        {"ts": 2.0, "source": "bot", "command": "failed_task", "user_id": user, "args": ["pTask"]},
+        {"ts": 3.0, "source": "bot", "command": "status", "user_id": user, "args": []},
+    ]
+
+    latencies, final_state, errors = traffic.replay(records, snapshot)
+
+    assert errors == []
+    assert final_state[user]["experience"] == 10 and final_state[user]["health"] == 90
+    differences = traffic.diff_states(snapshot, final_state)
+    assert (f"/{user}/experience", 0, 10) in differences
+    assert "bot /status" in traffic.format_report(latencies, differences, errors)
+
+
+def test_replay_speed_follows_captured_pacing(data_file):
+    records = [{"ts": 100.0 + i * 0.1, "source": "http", "method": "GET", "path": f"/api/user/{i}",
+                "query": "", "body": None, "status": 200} for i in range(3)]
+
+    started = time.perf_counter()
+    traffic.replay(records, {}, speed=1)
+    assert time.perf_counter() - started >= 0.2
+
+    started = time.perf_counter()
+    traffic.replay(records, {}, speed=None)
+    assert time.perf_counter() - started < 0.2
@@ -0,0 +1,446 @@
+"""Production traffic capture and deterministic replay.
+
+Capture is enabled by setting TELEHABIT_CAPTURE_FILE (a JSONL file to append
+to) and TELEHABIT_CAPTURE_KEY (a secret). app.py then records every API
+request through CaptureMiddleware and main.py records every bot command and
+panel tap. Records are sanitized: user ids and task/habit names are replaced
+by keyed pseudonyms, free-text fields by placeholders of the same length, and
+no headers are kept.
+
+Usage:
+    python traffic.py snapshot --data-file user_data.json --out snapshot.json
+    python traffic.py replay capture.jsonl --snapshot snapshot.json [--speed 1|10|max]
+
+snapshot pseudonymizes a data file with the same key, so a capture can be
+replayed against it. replay re-drives the capture in-process against a
+scratch copy of the snapshot, then reports latency percentiles per endpoint
+and the differences in final state.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import io
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlencode
+
+# Body fields kept verbatim; other strings are replaced by placeholders.
+VERBATIM_FIELDS = ('frequency',)
+# Fields that hold names used as ids, pseudonymized consistently.
+NAME_FIELDS = ('name',)
+# Changes replay cannot reproduce exactly (wall-clock timestamps, counters).
+VOLATILE_FIELDS = ('last_completed_date', 'version')
+
+
+class CaptureWriter:
+    """Appends records to a JSONL file, safely from many threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', buffering=1) # Line buffered: records survive a crash
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Sanitizer:
+    """Pseudonymizes user ids and item names with a keyed hash, and masks free text."""
+
+    def __init__(self, key):
+        self._key = key.encode('utf-8')
+
+    def pseudonym(self, value):
+        digest = hmac.new(self._key, str(value).encode('utf-8'), hashlib.sha256).hexdigest()
+        return 'p' + digest[:16]
+
+    def text(self, value):
+        return 'x' * len(value)
+
+    def path(self, path):
+        parts = path.split('/')
+        # ['', 'api', 'user', <user_id>, 'tasks' | 'habits', <name>, ...]
+        if len(parts) > 3 and parts[1:3] == ['api', 'user']:
+            parts[3] = self.pseudonym(parts[3])
+            if len(parts) > 5 and parts[4] in ('tasks', 'habits'):
+                parts[5] = self.pseudonym(parts[5])
+        return '/'.join(parts)
+
+    def query(self, query_string):
+        params = [(key, self.pseudonym(value) if key == 'user_id' else value)
+                  for key, value in parse_qsl(query_string, keep_blank_values=True)]
+        return urlencode(params)
+
+    def body(self, body):
+        if not isinstance(body, dict):
+            return None
+        sanitized = {}
+        for field, value in body.items():
+            if isinstance(value, str):
+                if field in NAME_FIELDS:
+                    value = self.pseudonym(value)
+                elif field not in VERBATIM_FIELDS:
+                    value = self.text(value)
+            elif isinstance(value, (dict, list)):
+                continue # Not part of the API; keeps arbitrary payloads out of captures
+            sanitized[field] = value
+        return sanitized
+
+    def callback_data(self, data):
+        import status_panel
+        parsed = status_panel.parse_callback_data(data or '')
+        if parsed is None:
+            return None
+        action, version, task_name = parsed
+        if task_name is not None:
+            task_name = self.pseudonym(task_name)
+        return status_panel.callback_data(action, version, task_name)
+
+    def user_data(self, users):
+        """Pseudonymizes a whole user_data mapping, consistently with captured traffic."""
+        sanitized = {}
+        for user_id, user_data in users.items():
+            record = dict(user_data)
+            for collection in ('tasks', 'habits'):
+                items = {}
+                for name, item in (user_data.get(collection) or {}).items():
+                    item = dict(item) if isinstance(item, dict) else {}
+                    if isinstance(item.get('description'), str):
+                        item['description'] = self.text(item['description'])
+                    items[self.pseudonym(name)] = item
+                record[collection] = items
+            sanitized[self.pseudonym(user_id)] = record
+        return sanitized
+
+
+class CaptureMiddleware:
+    """WSGI middleware recording sanitized API requests with timestamps and latency."""
+
+    def __init__(self, app, writer, sanitizer, max_body=None):
+        import quotas
+        self.app = app
+        self.writer = writer
+        self.sanitizer = sanitizer
+        self.max_body = quotas.MAX_REQUEST_BYTES if max_body is None else max_body
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith('/api/') or path.startswith('/api/admin/'):
+            return self.app(environ, start_response) # Admin calls are never captured or replayed
+
+        body = None
+        length = environ.get('CONTENT_LENGTH')
+        if length and length.isdigit() and 0 < int(length) <= self.max_body:
+            raw = environ['wsgi.input'].read(int(length))
+            environ['wsgi.input'] = io.BytesIO(raw) # Let the app read the body again
+            try:
+                body = json.loads(raw)
+            except ValueError:
+                body = None
+
+        status = {}
+        def capturing_start_response(status_line, headers, exc_info=None):
+            status['code'] = int(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        with self._seq_lock:
+            self._seq += 1
+            seq = self._seq
+        timestamp = time.time()
+        start = time.perf_counter()
+        result = self.app(environ, capturing_start_response)
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        self.writer.write({
+            "seq": seq,
+            "ts": timestamp,
+            "source": "http",
+            "method": environ.get('REQUEST_METHOD', 'GET'),
+            "path": self.sanitizer.path(path),
+            "query": self.sanitizer.query(environ.get('QUERY_STRING', '')),
+            "body": self.sanitizer.body(body),
+            "status": status.get('code'),
+            "duration_ms": round(duration_ms, 3),
+        })
+        return result
+
+
+class BotCapture:
+    """Wraps bot handlers to record sanitized commands and panel taps."""
+
+    def __init__(self, writer, sanitizer):
+        self.writer = writer
+        self.sanitizer = sanitizer
+
+    def wrap(self, command, handler):
+        async def captured_handler(update, context):
+            timestamp = time.time()
+            start = time.perf_counter()
+            try:
+                return await handler(update, context)
+            finally:
+                record = {
+                    "ts": timestamp,
+                    "source": "bot",
+                    "command": command,
+                    "user_id": self.sanitizer.pseudonym(update.effective_user.id),
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                }
+                if command == 'callback':
+                    record["data"] = self.sanitizer.callback_data(update.callback_query.data)
+                else:
+                    args = getattr(context, 'args', None) or []
+                    # Commands take a single task name, pseudonymized as a whole.
+                    record["args"] = [self.sanitizer.pseudonym(' '.join(args))] if args else []
+                self.writer.write(record)
+        captured_handler.__name__ = getattr(handler, '__name__', command)
+        captured_handler.__doc__ = getattr(handler, '__doc__', None)
+        return captured_handler
+
+
+def capture_from_env():
+    """Returns (CaptureWriter, Sanitizer) if TELEHABIT_CAPTURE_FILE is set, else None."""
+    path = os.environ.get('TELEHABIT_CAPTURE_FILE')
+    if not path:
+        return None
+    key = os.environ.get('TELEHABIT_CAPTURE_KEY')
+    if not key:
+        raise ValueError("Please set TELEHABIT_CAPTURE_KEY to capture traffic")
+    return CaptureWriter(path), Sanitizer(key)
+
+
+# --- Replay ---
+
+def load_capture(path):
+    with open(path, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: (record["ts"], record.get("seq", 0)))
+
+
+def _route(record):
+    """Groups a record for the latency report, e.g. 'POST /api/user/<user>/tasks/<name>/fail'."""
+    if record["source"] == "bot":
+        return f"bot /{record['command']}"
+    parts = record["path"].split('/')
+    if len(parts) > 3 and parts[1:3] == ['api', 'user']:
+        parts[3] = '<user>'
+        if len(parts) > 5:
+            parts[5] = '<name>'
+    return f"{record['method']} {'/'.join(parts)}"
+
+
+def _record_user(record):
+    if record["source"] == "bot":
+        return record["user_id"]
+    parts = record["path"].split('/')
+    return parts[3] if len(parts) > 3 else ''
+
+
+class _ReplayBot:
+    """Drives main.py's handlers with stand-ins for Telegram updates; replies are dropped."""
+
+    def __init__(self):
+        import main
+        self.handlers = {
+            'start': main.start,
+            'complete_task': main.complete_task,
+            'failed_task': main.failed_task,
+            'status': main.status,
+            'webapp': main.webapp_command_handler,
+            'callback': main.status_panel_callback,
+        }
+
+    @staticmethod
+    async def _ignore(*args, **kwargs):
+        return None
+
+    def run(self, record):
+        user = SimpleNamespace(id=record["user_id"])
+        update = SimpleNamespace(
+            effective_user=user,
+            message=SimpleNamespace(reply_text=self._ignore),
+            callback_query=SimpleNamespace(data=record.get("data"), from_user=user,
+                                           answer=self._ignore, edit_message_text=self._ignore),
+        )
+        context = SimpleNamespace(args=list(record.get("args", [])))
+        asyncio.run(self.handlers[record["command"]](update, context))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def diff_states(before, after, ignore=VOLATILE_FIELDS, path=''):
+    """Returns [(path, before, after)] for every value that differs between two states."""
+    if isinstance(before, dict) and isinstance(after, dict):
+        differences = []
+        for key in sorted(set(before) | set(after), key=str):
+            if key in ignore:
+                continue
+            differences.extend(diff_states(before.get(key), after.get(key), ignore, f"{path}/{key}"))
+        return differences
+    return [] if before == after else [(path, before, after)]
+
+
+def replay(records, snapshot, speed=None, workers=8):
+    """Replays records against a scratch copy of snapshot.
+
+    speed is a multiplier of the captured pacing; None replays as fast as
+    possible. Each user's records run in capture order on one worker, so the
+    final state is deterministic; different users run concurrently.
+    Returns (latencies_ms by route, final state, errors).
+    """
+    import data_manager
+    from app import app
+
+    scratch = tempfile.mkdtemp()
+    original = (data_manager.DATA_FILE, data_manager.STORE, app.wsgi_app)
+    data_manager.DATA_FILE = os.path.join(scratch, 'user_data.json')
+    data_manager.STORE = None
+    data_manager.save_user_data(snapshot)
+    # Importing app enables capture if TELEHABIT_CAPTURE_FILE is still set; the
+    # replay must not record itself, possibly into the capture being replayed.
+    while isinstance(app.wsgi_app, CaptureMiddleware):
+        app.wsgi_app = app.wsgi_app.app
+
+    bot = _ReplayBot()
+    latencies = {}
+    errors = []
+    results_lock = threading.Lock()
+    queues = [queue.Queue() for _ in range(workers)]
+
+    def execute(client, record):
+        start = time.perf_counter()
+        if record["source"] == "bot":
+            bot.run(record)
+        else:
+            query = f"?{record['query']}" if record.get("query") else ''
+            response = client.open(record["path"] + query, method=record["method"], json=record.get("body"))
+            response.close()
+            if record.get("status") is not None and response.status_code != record["status"]:
+                raise AssertionError(f"status {response.status_code}, captured {record['status']}")
+        return (time.perf_counter() - start) * 1000
+
+    def worker(q):
+        client = app.test_client()
+        while True:
+            record = q.get()
+            if record is None:
+                return
+            try:
+                elapsed = execute(client, record)
+                with results_lock:
+                    latencies.setdefault(_route(record), []).append(elapsed)
+            except Exception as e:
+                with results_lock:
+                    errors.append((_route(record), f"{type(e).__name__}: {e}"))
+
+    threads = [threading.Thread(target=worker, args=(q,), daemon=True) for q in queues]
+    for t in threads:
+        t.start()
+    try:
+        start = time.monotonic()
+        first_ts = records[0]["ts"] if records else 0
+        for record in records:
+            if record["source"] == "http" and record["path"].endswith('/events'):
+                continue # Live update streams never finish; nothing to measure
+            if speed is not None:
+                delay = start + (record["ts"] - first_ts) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            user = _record_user(record)
+            queues[zlib.crc32(user.encode('utf-8')) % workers].put(record)
+        for q in queues:
+            q.put(None)
+        for t in threads:
+            t.join()
+        final_state = data_manager.load_user_data()
+    finally:
+        data_manager.DATA_FILE, data_manager.STORE, app.wsgi_app = original
+        shutil.rmtree(scratch)
+    return latencies, final_state, errors
+
+
+def format_report(latencies, differences, errors, max_differences=20):
+    lines = [f"{'route':<45} {'count':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+    for route in sorted(latencies):
+        values = sorted(latencies[route])
+        lines.append(f"{route:<45} {len(values):>6} {percentile(values, 0.5):>8.2f} "
+                     f"{percentile(values, 0.9):>8.2f} {percentile(values, 0.99):>8.2f} {values[-1]:>8.2f}")
+    if errors:
+        lines.append(f"\n{len(errors)} records failed:")
+        lines.extend(f"  {route}: {error}" for route, error in errors[:max_differences])
+    lines.append(f"\n{len(differences)} differences in final state:")
+    lines.extend(f"  {path}: {json.dumps(before)} -> {json.dumps(after)}"
+                 for path, before, after in differences[:max_differences])
+    if len(differences) > max_differences:
+        lines.append(f"  ... and {len(differences) - max_differences} more")
+    return '\n'.join(lines)
+
+
+def _parse_speed(value):
+    if value == 'max':
+        return None
+    speed = float(value.rstrip('x'))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Snapshot user data and replay captured traffic.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    snapshot_parser = commands.add_parser('snapshot', help="Write a pseudonymized copy of a data file")
+    snapshot_parser.add_argument('--data-file', default='user_data.json')
+    snapshot_parser.add_argument('--out', required=True)
+    replay_parser = commands.add_parser('replay', help="Replay a capture against a snapshot")
+    replay_parser.add_argument('capture', help="JSONL capture file")
+    replay_parser.add_argument('--snapshot', default=None, help="Snapshot to start from (default: empty)")
+    replay_parser.add_argument('--expected', default=None,
+                               help="State to compare the result with (default: the starting snapshot)")
+    replay_parser.add_argument('--speed', type=_parse_speed, default=None,
+                               help="1 for captured pacing, N for N times faster, 'max' (default) for no pauses")
+    replay_parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    if args.command == 'snapshot':
+        key = os.environ.get('TELEHABIT_CAPTURE_KEY')
+        if not key:
+            parser.exit(1, "Please set TELEHABIT_CAPTURE_KEY (the key used for capturing)\n")
+        import data_manager
+        users = Sanitizer(key).user_data(data_manager.load_data_file(args.data_file))
+        data_manager.save_data_file(args.out, users)
+        print(f"Wrote {len(users)} pseudonymized users to {args.out}.")
+    elif args.command == 'replay':
+        import data_manager
+        snapshot = data_manager.load_data_file(args.snapshot) if args.snapshot else {}
+        expected = data_manager.load_data_file(args.expected) if args.expected else snapshot
+        records = load_capture(args.capture)
+        started = time.perf_counter()
+        latencies, final_state, errors = replay(records, snapshot, args.speed, args.workers)
+        elapsed = time.perf_counter() - started
+        print(f"Replayed {sum(map(len, latencies.values()))} of {len(records)} records in {elapsed:.2f}s")
+        print(format_report(latencies, diff_states(expected, final_state), errors))
+
+
+if __name__ == '__main__':
+    main()